@@ -0,0 +1,42 @@
+# app/binance.py
+
+import os
+import logging
+from typing import Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# =========================
+# CLIENTE HTTP BINANCE FUTURES
+# =========================
+
+BINANCE_FUTURES_API = os.getenv("BINANCE_FUTURES_API", "https://fapi.binance.com")
+REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "15"))
+
+# Conexiones keep-alive reutilizadas entre peticiones (HTTP/2 multiplexa
+# las concurrentes sobre la misma conexión TLS)
+HTTP_LIMITS = httpx.Limits(
+    max_connections=int(os.getenv("BINANCE_MAX_CONNECTIONS", "100")),
+    max_keepalive_connections=int(os.getenv("BINANCE_MAX_KEEPALIVE", "20")),
+)
+
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Cliente httpx compartido para la API de Binance.
+    Se crea en el primer uso, dentro del event loop del scanner,
+    que es el único que lo utiliza.
+    """
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            base_url=BINANCE_FUTURES_API,
+            http2=True,
+            timeout=REQUEST_TIMEOUT,
+            limits=HTTP_LIMITS,
+        )
+    return _http_client
@@ -5,16 +5,14 @@ import os
 import logging
 import threading
 import signal
-import sys
-from telegram import Update
-from telegram.ext import Application, CommandHandler
+from concurrent.futures import ThreadPoolExecutor
+from telegram.ext import Application
 
-from app.database import users_collection
-from app.models import new_user
+from app.config import BOT_NAME
+from app.database import ensure_indexes
 from app.handlers import get_handlers
 from app.scanner import scan_market
 from app.scheduler import scheduler_loop
-from app.menus import main_menu
 
 # Configurar logging
 logging.basicConfig(
@@ -32,70 +30,64 @@ if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN no está definido")
 
 # ======================================================
-# NOMBRE DEL BOT (PARA ENLACES Y MENSAJES)
+# LONG POLLING
 # ======================================================
+# Telegram mantiene abierta cada petición getUpdates hasta POLL_TIMEOUT
+# segundos (máximo 50). Valores bajos reducen la latencia de reconexión
+# a costa de más peticiones en despliegues con datos limitados.
 
-BOT_NAME = "HADES_FT_BOT"
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "50"))
+
+# Hilos del executor por defecto del loop (asyncio.to_thread / run_in_executor).
+# Los handlers usan Motor, así que solo queda trabajo puntual bloqueante.
+EXECUTOR_WORKERS = int(os.getenv("BOT_EXECUTOR_WORKERS", "4"))
 
 # ======================================================
-# /START
+# TAREAS EN EL EVENT LOOP DEL BOT
 # ======================================================
 
-async def start(update: Update, context):
-    user = update.effective_user
-    args = context.args
-
-    users_col = users_collection()
-    existing_user = users_col.find_one({"user_id": user.id})
-
-    referred_by = None
-    if args and not existing_user:
-        ref_arg = args[0]
-        if ref_arg.startswith("ref_"):
-            try:
-                ref_user_id = int(ref_arg.replace("ref_", ""))
-                if ref_user_id != user.id:
-                    if users_col.find_one({"user_id": ref_user_id}):
-                        referred_by = ref_user_id
-            except ValueError:
-                referred_by = None
-
-    if not existing_user:
-        user_doc = new_user(
-            user_id=user.id,
-            username=user.username,
-            referred_by=referred_by,
-        )
-        users_col.insert_one(user_doc)
-
-        welcome_text = (
-            f"Bienvenido a {BOT_NAME}.\n\n"
-            "Tu acceso gratuito de prueba ha sido activado por 7 días.\n\n"
-            f"Invita amigos usando tu enlace de referido:\nhttps://t.me/{BOT_NAME}?start=ref_{user.id}\n\n"
-            "Utiliza el menú para navegar."
-        )
-        logger.info(f"Nuevo usuario registrado: {user.id} (@{user.username})")
-    else:
-        welcome_text = (
-            f"Bienvenido de nuevo a {BOT_NAME}.\n\n"
-            "Utiliza el menú para acceder a las funciones disponibles."
-        )
+_background_tasks = []
 
-    await update.message.reply_text(
-        text=welcome_text,
-        reply_markup=main_menu(),
+async def post_init(application: Application):
+    """Crea índices y arranca el scheduler en el event loop de Telegram."""
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS, thread_name_prefix="bot-exec")
     )
+    await asyncio.to_thread(ensure_indexes)
+
+    logger.info("⏰ Iniciando scheduler en el event loop principal...")
+    _background_tasks.append(asyncio.create_task(scheduler_loop()))
+
+async def post_shutdown(application: Application):
+    """Cancela las tareas de fondo antes de cerrar el event loop."""
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
 
 # ======================================================
 # RUN BOT (ENTRYPOINT ÚNICO)
 # ======================================================
 
 def run_bot():
+    # Event loop de libuv si está disponible (no existe en Windows)
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        logger.info("⚡ uvloop activado")
+    except ImportError:
+        logger.info("uvloop no disponible, usando asyncio estándar")
+
     # Crear aplicación
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
-    # Handlers
-    application.add_handler(CommandHandler("start", start))
+    # Handlers (incluye /start)
     for handler in get_handlers():
         application.add_handler(handler)
 
@@ -103,7 +95,7 @@ def run_bot():
     bot = application.bot
 
     # ==============================
-    # BACKGROUND THREADS CON MANEJO DE ERRORES
+    # SCANNER EN THREAD DEDICADO
     # ==============================
 
     def run_scanner():
@@ -112,66 +104,35 @@ def run_bot():
             logger.info("📡 Iniciando thread del scanner...")
             scan_market(bot)
         except Exception as e:
-            logger.error(f"❌ Thread scanner falló: {e}", exc_info=True)
-
-    def run_scheduler():
-        """Ejecuta el scheduler en un thread dedicado (modo seguro)."""
-        try:
-            logger.info("⏰ Iniciando thread del scheduler (modo seguro)...")
-            asyncio.run(scheduler_loop())
-        except Exception as e:
-            logger.error(f"❌ Thread scheduler falló: {e}", exc_info=True)
+            logger.error("❌ Thread scanner falló: %s", e, exc_info=True)
 
-    # Iniciar threads con nombres para debugging
+    # Iniciar thread con nombre para debugging
     scanner_thread = threading.Thread(
         target=run_scanner,
         daemon=True,
         name="ScannerThread"
     )
-    
-    scheduler_thread = threading.Thread(
-        target=run_scheduler,
-        daemon=True,
-        name="SchedulerThread"
-    )
-    
-    scanner_thread.start()
-    scheduler_thread.start()
-    
-    logger.info("✅ Threads de fondo iniciados correctamente")
 
-    # ==============================
-    # MANEJO DE SEÑALES PARA SHUTDOWN ELEGANTE
-    # ==============================
+    scanner_thread.start()
 
-    def signal_handler(sig, frame):
-        """Maneja señales de terminación."""
-        logger.info(f"\n🛑 Recibida señal de terminación ({sig})...")
-        
-        # Detener la aplicación
-        if application.running:
-            logger.info("Deteniendo aplicación de Telegram...")
-            application.stop()
-        
-        logger.info("Bot detenido correctamente")
-        sys.exit(0)
-
-    # Registrar manejadores de señales
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
+    logger.info("✅ Thread del scanner iniciado correctamente")
 
     # ==============================
     # INICIAR POLLING
     # ==============================
 
-    logger.info(f"🤖 {BOT_NAME} iniciando...")
+    logger.info("🤖 %s iniciando...", BOT_NAME)
     
     try:
         application.run_polling(
-            poll_interval=0.5,
-            timeout=30,
-            drop_pending_updates=True
+            poll_interval=0.0,
+            timeout=POLL_TIMEOUT,
+            drop_pending_updates=True,
+            bootstrap_retries=-1,
+            # PTB registra estas señales con loop.add_signal_handler y ejecuta
+            # stop() + shutdown() (y post_shutdown) dentro del event loop.
+            stop_signals=(signal.SIGINT, signal.SIGTERM),
         )
     except Exception as e:
-        logger.error(f"❌ Error en run_polling: {e}", exc_info=True)
+        logger.error("❌ Error en run_polling: %s", e, exc_info=True)
         raise
@@ -1,7 +1,14 @@
 # app/config.py
 
 import os
-from typing import List
+from typing import FrozenSet, Tuple
+
+
+# ======================================================
+# NOMBRE DEL BOT (PARA ENLACES Y MENSAJES)
+# ======================================================
+
+BOT_NAME = "HADES_FT_BOT"
 
 
 # ======================================================
@@ -10,16 +17,21 @@ from typing import List
 # Coloca aquí los USER_ID de Telegram de los admins usando variables de entorno.
 # ADMIN_USER_ID_1 = tu ID
 # ADMIN_USER_ID_2 = ID de tu hermano
+# Las variables no definidas ("0") se descartan.
 
-ADMIN_USER_IDS: List[int] = [
-    int(os.getenv("ADMIN_USER_ID_1", "0")),
-    int(os.getenv("ADMIN_USER_ID_2", "0")),
-]
+ADMIN_USER_IDS: FrozenSet[int] = frozenset(
+    int(v)
+    for v in (
+        os.getenv("ADMIN_USER_ID_1", "0"),
+        os.getenv("ADMIN_USER_ID_2", "0"),
+    )
+    if v != "0"
+)
 
 
 def is_admin(user_id: int) -> bool:
     """
-    Verifica si un user_id es administrador.
+    Verifica si un user_id es administrador (una búsqueda en el frozenset).
     """
     return user_id in ADMIN_USER_IDS
 
@@ -30,14 +42,18 @@ def is_admin(user_id: int) -> bool:
 # ADMIN_WHATSAPP_1 = tu WhatsApp
 # ADMIN_WHATSAPP_2 = WhatsApp de tu hermano
 
-ADMIN_WHATSAPPS: List[str] = [
-    os.getenv("ADMIN_WHATSAPP_1", "").strip(),
-    os.getenv("ADMIN_WHATSAPP_2", "").strip(),
-]
+ADMIN_WHATSAPPS: Tuple[str, ...] = tuple(
+    w
+    for w in (
+        os.getenv("ADMIN_WHATSAPP_1", "").strip(),
+        os.getenv("ADMIN_WHATSAPP_2", "").strip(),
+    )
+    if w
+)
 
 
-def get_admin_whatsapps() -> List[str]:
+def get_admin_whatsapps() -> Tuple[str, ...]:
     """
-    Retorna la lista de WhatsApps válidos (no vacíos).
+    Retorna los WhatsApps válidos (no vacíos), filtrados al importar.
     """
-    return [w for w in ADMIN_WHATSAPPS if w]
+    return ADMIN_WHATSAPPS
@@ -1,7 +1,11 @@
 # app/database.py
 
 import os
-from pymongo import MongoClient
+import logging
+from functools import lru_cache
+from pymongo import MongoClient, ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure, PyMongoError
+from motor.motor_asyncio import AsyncIOMotorClient
 
 # =========================
 # CONEXIÓN MONGODB
@@ -13,14 +17,33 @@ DATABASE_NAME = os.getenv("DATABASE_NAME")
 if not MONGODB_URI or not DATABASE_NAME:
     raise RuntimeError("MONGODB_URI o DATABASE_NAME no están definidos")
 
+logger = logging.getLogger(__name__)
+
+# Pool dimensionado para la carga del bot (pocas decenas de operaciones
+# concurrentes). connect=False difiere la conexión al primer uso.
+MONGO_POOL_OPTIONS = {
+    "maxPoolSize": int(os.getenv("MONGO_MAX_POOL_SIZE", "20")),
+    "minPoolSize": int(os.getenv("MONGO_MIN_POOL_SIZE", "2")),
+    "waitQueueTimeoutMS": int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "2000")),
+    "serverSelectionTimeoutMS": int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "3000")),
+    # Una operación colgada no debe retener una conexión del pool
+    "socketTimeoutMS": int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "5000")),
+    "appname": os.getenv("MONGO_APPNAME", "hades_ft"),
+    "connect": False,
+}
+
 # MongoClient global seguro para threads
 _client = None
 _db = None
 
+# Cliente Motor (async) para el event loop del bot
+_async_client = None
+_async_db = None
+
 def get_client() -> MongoClient:
     global _client
     if _client is None:
-        _client = MongoClient(MONGODB_URI)
+        _client = MongoClient(MONGODB_URI, **MONGO_POOL_OPTIONS)
     return _client
 
 def get_db():
@@ -29,11 +52,30 @@ def get_db():
         _db = get_client()[DATABASE_NAME]
     return _db
 
+def get_async_client() -> AsyncIOMotorClient:
+    """
+    Cliente Motor para los handlers de Telegram.
+    Solo debe usarse desde el event loop del bot; el scanner y el
+    scheduler (threads propios) siguen usando el MongoClient síncrono.
+    """
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncIOMotorClient(MONGODB_URI, **MONGO_POOL_OPTIONS)
+    return _async_client
+
+def get_async_db():
+    global _async_db
+    if _async_db is None:
+        _async_db = get_async_client()[DATABASE_NAME]
+    return _async_db
+
 
 # =========================
 # COLECCIONES PRINCIPALES
 # =========================
+# Los handles de colección se crean una sola vez y se reutilizan.
 
+@lru_cache(maxsize=None)
 def users_collection():
     """
     Usuarios del bot
@@ -41,6 +83,15 @@ def users_collection():
     return get_db()["users"]
 
 
+@lru_cache(maxsize=None)
+def users_collection_async():
+    """
+    Usuarios del bot (Motor, para handlers async)
+    """
+    return get_async_db()["users"]
+
+
+@lru_cache(maxsize=None)
 def referrals_collection():
     """
     Historial de referidos válidos
@@ -48,6 +99,7 @@ def referrals_collection():
     return get_db()["referrals"]
 
 
+@lru_cache(maxsize=None)
 def signals_collection():
     """
     Señales BASE generadas por el scanner
@@ -55,6 +107,7 @@ def signals_collection():
     return get_db()["signals"]
 
 
+@lru_cache(maxsize=None)
 def user_signals_collection():
     """
     Señales PERSONALIZADAS entregadas a cada usuario
@@ -62,6 +115,7 @@ def user_signals_collection():
     return get_db()["user_signals"]
 
 
+@lru_cache(maxsize=None)
 def signal_results_collection():
     """
     Resultados de señales (para estadísticas):
@@ -71,3 +125,74 @@ def signal_results_collection():
     - plan
     """
     return get_db()["signal_results"]
+
+
+# =========================
+# ÍNDICES
+# =========================
+# (colección, claves, opciones). create_index es idempotente, así que
+# ensure_indexes() puede ejecutarse en cada arranque.
+
+SIGNALS_RETENTION_DAYS = int(os.getenv("SIGNALS_RETENTION_DAYS", "7"))
+USER_SIGNALS_RETENTION_DAYS = int(os.getenv("USER_SIGNALS_RETENTION_DAYS", "3"))
+
+# Claves reutilizadas como hint en las consultas de existencia de señales
+SIGNALS_DEDUP_INDEX = [("symbol", ASCENDING), ("direction", ASCENDING), ("visibility", ASCENDING), ("created_at", DESCENDING)]
+SIGNALS_SYMBOL_INDEX = [("symbol", ASCENDING), ("created_at", DESCENDING)]
+
+INDEXES = [
+    (users_collection, [("user_id", ASCENDING)], {"unique": True}),
+    # Elegibilidad de push (notifier._eligible_users_for_alert)
+    (users_collection, [("plan", ASCENDING), ("plan_end", ASCENDING)], {}),
+    (users_collection, [("plan", ASCENDING), ("trial_end", ASCENDING)], {}),
+    # Expiración de planes (plans.expire_plans)
+    (users_collection, [("plan_end", ASCENDING)], {}),
+    # Retención: MongoDB borra en segundo plano las señales caducadas (TTL)
+    (signals_collection, [("created_at", ASCENDING)], {"expireAfterSeconds": SIGNALS_RETENTION_DAYS * 86400}),
+    (user_signals_collection, [("created_at", ASCENDING)], {"expireAfterSeconds": USER_SIGNALS_RETENTION_DAYS * 86400}),
+    # Anti-duplicados y bloqueo por símbolo (signals.recent_duplicate_exists,
+    # signals.telegram_signal_blocked)
+    (signals_collection, SIGNALS_DEDUP_INDEX, {}),
+    (signals_collection, SIGNALS_SYMBOL_INDEX, {}),
+    # Señal vigente por usuario y símbolo (signals.generate_user_signal)
+    (user_signals_collection, [("user_id", ASCENDING), ("symbol", ASCENDING), ("telegram_valid_until", DESCENDING)], {}),
+    (user_signals_collection, [("user_id", ASCENDING), ("created_at", DESCENDING)], {}),
+    # Estadísticas de resultados ($match por fecha + $group por resultado)
+    (signal_results_collection, [("evaluated_at", DESCENDING), ("result", ASCENDING)], {}),
+    # Estadísticas de referidos ($match + $facet por plan activado)
+    (referrals_collection, [("referrer_id", ASCENDING), ("activated_plan", ASCENDING)], {}),
+    # Un referido cuenta una sola vez por referidor
+    (referrals_collection, [("referrer_id", ASCENDING), ("referred_id", ASCENDING)], {"unique": True}),
+]
+
+
+def ensure_indexes():
+    """
+    Crea los índices de las consultas principales.
+    Un índice que falla (p. ej. duplicados previos) no bloquea el arranque.
+    Usa un cliente propio sin socketTimeoutMS: el primer build (único o
+    TTL) sobre una colección con datos puede tardar más que el límite
+    de las operaciones normales.
+    """
+    options_no_timeout = {k: v for k, v in MONGO_POOL_OPTIONS.items() if k != "socketTimeoutMS"}
+    with MongoClient(MONGODB_URI, **options_no_timeout) as client:
+        db = client[DATABASE_NAME]
+        for collection, keys, options in INDEXES:
+            col = db[collection().name]
+            try:
+                col.create_index(keys, **options)
+            except PyMongoError as e:
+                logger.error(f"❌ No se pudo crear índice {keys} en {col.name}: {e}")
+
+
+def exists_with_hint(collection, query: dict, hint) -> bool:
+    """
+    count_documents(limit=1) forzando el índice `hint`. Si el índice no
+    existe (ensure_indexes es best-effort y pudo fallar al arrancar),
+    MongoDB rechaza el hint: se repite la consulta sin él.
+    """
+    try:
+        return collection.count_documents(query, limit=1, hint=hint) > 0
+    except OperationFailure as e:
+        logger.warning(f"⚠️ Hint {hint} no disponible en {collection.name}: {e}")
+        return collection.count_documents(query, limit=1) > 0
@@ -1,17 +1,18 @@
+import re
 import logging
 import asyncio
 from datetime import datetime, date
-from functools import partial
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ContextTypes, CallbackQueryHandler, MessageHandler, filters
+from telegram.ext import ContextTypes, CallbackQueryHandler, CommandHandler, MessageHandler, filters
 
-from app.database import users_collection
-from app.models import is_trial_active, is_plan_active, update_timestamp
+from app.database import users_collection_async
+from app.models import new_user, has_active_access, update_timestamp
 from app.plans import PLAN_FREE, PLAN_PLUS, PLAN_PREMIUM, activate_plus, activate_premium, extend_current_plan
 from app.signals import get_latest_base_signal_for_plan, generate_user_signal, format_user_signal
-from app.config import is_admin, get_admin_whatsapps
+from app.config import BOT_NAME, is_admin, get_admin_whatsapps
 from app.menus import main_menu, back_to_menu
-from app.referrals import get_user_referral_stats, get_referral_link, register_valid_referral, check_ref_rewards
+from app.notifier import invalidate_eligible_cache
+from app.referrals import get_user_referral_stats, get_referral_link, build_referral_link, register_valid_referral, check_ref_rewards
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +22,14 @@ DAILY_LIMITS = {
     PLAN_PREMIUM: 7,
 }
 
+# Campos del usuario que usan las acciones del menú
+_USER_MENU_PROJECTION = {"_id": 0, "user_id": 1, "plan": 1, "trial_end": 1, "plan_end": 1}
+
+_ADMIN_PANEL_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("➕ Activar plan", callback_data="admin_activate_plan")],
+    [InlineKeyboardButton("⬅️ Volver", callback_data="back_menu")],
+])
+
 # ======================================================
 # FUNCIONES AUXILIARES
 # ======================================================
@@ -33,6 +42,27 @@ def format_whatsapp_contacts():
         return f"WhatsApp: {whatsapps[0]}"
     return "WhatsApps:\n- " + "\n- ".join(whatsapps)
 
+_background_tasks = set()
+
+def _log_background_result(task: asyncio.Task):
+    _background_tasks.discard(task)
+    if task.cancelled():
+        return
+    exc = task.exception()
+    if exc:
+        logger.error("Error en tarea de fondo: %s", exc, exc_info=exc)
+
+def run_in_background(aw):
+    """
+    Ejecuta una escritura fuera del camino de respuesta al usuario.
+    Acepta cualquier awaitable: las operaciones de Motor devuelven un
+    Future, no una corrutina.
+    """
+    task = asyncio.ensure_future(aw)
+    _background_tasks.add(task)
+    task.add_done_callback(_log_background_result)
+    return task
+
 def parse_ref_code(start_param: str) -> int | None:
     """Extrae user_id del referidor desde start parameter de Telegram"""
     if not start_param:
@@ -45,36 +75,58 @@ def parse_ref_code(start_param: str) -> int | None:
     return None
 
 # ======================================================
-# HANDLER /start (inserta referidos)
+# HANDLER /start (registra usuario y referidos)
 # ======================================================
 
 async def handle_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Maneja /start y captura referidos"""
+    """Maneja /start: alta del usuario (con trial) y captura de referidos"""
     try:
-        user_id = update.effective_user.id
+        user = update.effective_user
         start_param = context.args[0] if context.args else None
         referrer_id = parse_ref_code(start_param)
 
-        users_col = users_collection()
-        user = users_col.find_one({"user_id": user_id})
+        users_col = users_collection_async()
 
-        if not user:
-            doc = {"user_id": user_id, "plan": PLAN_FREE, "ref_plus_valid": 0,
-                   "ref_premium_valid": 0, "ref_plus_total": 0, "ref_premium_total": 0}
-            if referrer_id and referrer_id != user_id:
-                doc["referred_by"] = referrer_id
-            users_col.insert_one(doc)
+        referred_by = None
+        if referrer_id and referrer_id != user.id:
+            if await users_col.find_one({"user_id": referrer_id}, {"_id": 1}):
+                referred_by = referrer_id
+
+        user_doc = new_user(
+            user_id=user.id,
+            username=user.username,
+            referred_by=referred_by,
+        )
+        # Alta atómica: un solo round-trip y sin carrera find_one → insert
+        result = await users_col.update_one(
+            {"user_id": user.id},
+            {"$setOnInsert": user_doc},
+            upsert=True,
+        )
+
+        if result.upserted_id is not None:
+            welcome_text = (
+                f"Bienvenido a {BOT_NAME}.\n\n"
+                "Tu acceso gratuito de prueba ha sido activado por 7 días.\n\n"
+                f"Invita amigos usando tu enlace de referido:\nhttps://t.me/{BOT_NAME}?start=ref_{user.id}\n\n"
+                "Utiliza el menú para navegar."
+            )
+            logger.info("Nuevo usuario registrado: %s (@%s)", user.id, user.username)
+            # El nuevo trial debe recibir pushes desde ya
+            invalidate_eligible_cache()
         else:
-            if referrer_id and referrer_id != user_id and "referred_by" not in user:
-                users_col.update_one({"user_id": user_id}, {"$set": {"referred_by": referrer_id}})
+            welcome_text = (
+                f"Bienvenido de nuevo a {BOT_NAME}.\n\n"
+                "Utiliza el menú para acceder a las funciones disponibles."
+            )
 
         await update.message.reply_text(
-            "👋 Bienvenido al bot de señales.\nMenú principal:",
+            text=welcome_text,
             reply_markup=main_menu(),
         )
 
     except Exception as e:
-        logger.error(f"Error en handle_start: {e}", exc_info=True)
+        logger.error("Error en handle_start: %s", e, exc_info=True)
         await update.message.reply_text("❌ Error al iniciar el bot.")
 
 # ======================================================
@@ -89,8 +141,8 @@ async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         user_id = query.from_user.id
-        users_col = users_collection()
-        user = users_col.find_one({"user_id": user_id})
+        users_col = users_collection_async()
+        user = await users_col.find_one({"user_id": user_id}, _USER_MENU_PROJECTION)
 
         if not user:
             await query.edit_message_text(
@@ -102,88 +154,68 @@ async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         action = query.data
         admin = is_admin(user_id)
 
-        if action == "admin_panel" and admin:
-            await query.edit_message_text(
-                "👑 PANEL ADMINISTRADOR",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("➕ Activar plan", callback_data="admin_activate_plan")],
-                    [InlineKeyboardButton("⬅️ Volver", callback_data="back_menu")],
-                ])
-            )
-            return
+        handler = _MENU_DISPATCH.get(action)
+        if handler is None and admin:
+            handler = _ADMIN_MENU_DISPATCH.get(action)
 
-        if action == "admin_activate_plan" and admin:
-            context.user_data["awaiting_user_id"] = True
-            await query.edit_message_text("🆔 Envía el User ID del usuario:")
-            return
+        if handler:
+            await handler(query, context, user, admin, users_col)
 
-        if action == "view_signals":
-            await handle_view_signals(query, user, admin, users_col)
-            return
+    except Exception as e:
+        logger.error("Error en handle_menu: %s", e, exc_info=True)
+        await query.edit_message_text(
+            "❌ Ocurrió un error inesperado.",
+            reply_markup=main_menu(),
+        )
 
-        if action == "plans":
-            await handle_plans(query)
-            return
+# ======================================================
+# ACCIONES DEL MENÚ
+# ======================================================
+# Todas reciben (query, context, user, admin, users_col) para poder
+# despacharse desde _MENU_DISPATCH / _ADMIN_MENU_DISPATCH.
 
-        if action == "my_account":
-            await handle_my_account(query, user, admin)
-            return
+async def _menu_admin_panel(query, context, user, admin, users_col):
+    await query.edit_message_text(
+        "👑 PANEL ADMINISTRADOR",
+        reply_markup=_ADMIN_PANEL_KB,
+    )
 
-        if action == "referrals":
-            await handle_referrals(query, user)
-            return
+async def _menu_admin_activate_plan(query, context, user, admin, users_col):
+    context.user_data["awaiting_user_id"] = True
+    await query.edit_message_text("🆔 Envía el User ID del usuario:")
 
-        if action == "support":
-            await handle_support(query)
-            return
+async def _menu_register_exchange(query, context, user, admin, users_col):
+    context.user_data["awaiting_exchange"] = True
+    await query.edit_message_text(
+        "🌐 Envía el nombre de tu exchange (ej: Binance, CoinEx, KuCoin):"
+    )
 
-        if action == "register_exchange":
-            context.user_data["awaiting_exchange"] = True
-            await query.edit_message_text(
-                "🌐 Envía el nombre de tu exchange (ej: Binance, CoinEx, KuCoin):"
-            )
-            return
+async def _menu_back(query, context, user, admin, users_col):
+    await query.edit_message_text(
+        "Menú principal",
+        reply_markup=main_menu(),
+    )
 
-        if action == "back_menu":
-            await query.edit_message_text(
-                "Menú principal",
-                reply_markup=main_menu(),
-            )
-            return
+async def _menu_choose_plan(query, context, user, admin, users_col):
+    target_user_id = context.user_data.get("target_user_id")
+    if not target_user_id:
+        return
 
-        if action in ["choose_plus_plan", "choose_premium_plan"]:
-            target_user_id = context.user_data.get("target_user_id")
-            if target_user_id:
-                loop = asyncio.get_event_loop()
-                if action == "choose_plus_plan":
-                    success = await loop.run_in_executor(
-                        None,
-                        partial(activate_plus, target_user_id)
-                    )
-                    plan_name = "PLUS"
-                else:
-                    success = await loop.run_in_executor(
-                        None,
-                        partial(activate_premium, target_user_id)
-                    )
-                    plan_name = "PREMIUM"
-
-                if success:
-                    register_valid_referral(target_user_id, plan_name)
-                    await query.edit_message_text(f"✅ Plan {plan_name} activado correctamente.")
-                else:
-                    await query.edit_message_text(f"❌ No se pudo activar el plan {plan_name}.")
-
-                context.user_data.pop("awaiting_plan_choice", None)
-                context.user_data.pop("target_user_id", None)
-            return
+    if query.data == "choose_plus_plan":
+        activate, plan_name = activate_plus, "PLUS"
+    else:
+        activate, plan_name = activate_premium, "PREMIUM"
 
-    except Exception as e:
-        logger.error(f"Error en handle_menu: {e}", exc_info=True)
-        await query.edit_message_text(
-            "❌ Ocurrió un error inesperado.",
-            reply_markup=main_menu(),
-        )
+    success = await asyncio.to_thread(activate, target_user_id)
+
+    if success:
+        register_valid_referral(target_user_id, plan_name)
+        await query.edit_message_text(f"✅ Plan {plan_name} activado correctamente.")
+    else:
+        await query.edit_message_text(f"❌ No se pudo activar el plan {plan_name}.")
+
+    context.user_data.pop("awaiting_plan_choice", None)
+    context.user_data.pop("target_user_id", None)
 
 # ======================================================
 # HANDLER REFERRALS
@@ -200,36 +232,48 @@ async def handle_referrals(query, user):
             )
             return
 
-        ref_link = get_referral_link(user_id)
-
-        message = "👥 SISTEMA DE REFERIDOS\n\n"
-        message += f"🔗 Tu enlace de referido:\n{ref_link}\n\n"
-
-        message += "📊 ESTADÍSTICAS:\n"
-        message += f"• Total referidos: {stats['total_referred']}\n"
-        message += f"• Referidos PLUS: {stats['plus_referred']}\n"
-        message += f"• Referidos PREMIUM: {stats['premium_referred']}\n\n"
-
-        message += "🎯 CONTADORES ACTUALES:\n"
-        message += f"• PLUS válidos: {stats['current_plus']}/5 → Ganancia: {stats['current_plus']*2} USDT\n"
-        message += f"• PREMIUM válidos: {stats['current_premium']}/5 → Ganancia: {stats['current_premium']*4} USDT\n\n"
+        # El ref_code ya viene en las estadísticas: sin segunda consulta
+        ref_link = build_referral_link(stats["ref_code"])
+
+        parts = [
+            "👥 SISTEMA DE REFERIDOS",
+            "",
+            f"🔗 Tu enlace de referido:\n{ref_link}",
+            "",
+            "📊 ESTADÍSTICAS:",
+            f"• Total referidos: {stats['total_referred']}",
+            f"• Referidos PLUS: {stats['plus_referred']}",
+            f"• Referidos PREMIUM: {stats['premium_referred']}",
+            "",
+            "🎯 CONTADORES ACTUALES:",
+            f"• PLUS válidos: {stats['current_plus']}/5 → Ganancia: {stats['current_plus']*2} USDT",
+            f"• PREMIUM válidos: {stats['current_premium']}/5 → Ganancia: {stats['current_premium']*4} USDT",
+            "",
+        ]
 
         if stats["pending_rewards"]:
-            message += "✨ RECOMPENSAS PENDIENTES:\n"
-            for reward in stats["pending_rewards"]:
-                message += f"• {reward}\n"
-            message += "\n"
+            parts.append("✨ RECOMPENSAS PENDIENTES:")
+            parts.extend(f"• {reward}" for reward in stats["pending_rewards"])
         else:
-            message += "📝 No tienes recompensas pendientes\n\n"
-
-        message += "📢 CÓMO REFERIR:\n1. Comparte tu enlace\n2. Ellos entran al bot\n3. Activan un plan\n\n"
-        message += "📌 REGLAS:\n"
-        message += "• FREE: 5 PLUS = Plan PLUS gratis\n"
-        message += "• FREE: 5 PREMIUM = Plan PREMIUM gratis\n"
-        message += "• PLUS: 5 PLUS = Extender plan\n"
-        message += "• PLUS: 5 PREMIUM = Subir a PREMIUM\n"
-        message += "• PREMIUM: 5 PREMIUM = Extender plan\n"
-        message += "• PREMIUM: 10 PLUS = Extender plan\n"
+            parts.append("📝 No tienes recompensas pendientes")
+
+        parts.extend([
+            "",
+            "📢 CÓMO REFERIR:",
+            "1. Comparte tu enlace",
+            "2. Ellos entran al bot",
+            "3. Activan un plan",
+            "",
+            "📌 REGLAS:",
+            "• FREE: 5 PLUS = Plan PLUS gratis",
+            "• FREE: 5 PREMIUM = Plan PREMIUM gratis",
+            "• PLUS: 5 PLUS = Extender plan",
+            "• PLUS: 5 PREMIUM = Subir a PREMIUM",
+            "• PREMIUM: 5 PREMIUM = Extender plan",
+            "• PREMIUM: 10 PLUS = Extender plan",
+            "",
+        ])
+        message = "\n".join(parts)
 
         keyboard = [
             [InlineKeyboardButton("📋 Copiar enlace", callback_data="copy_ref_code")],
@@ -242,7 +286,7 @@ async def handle_referrals(query, user):
         )
 
     except Exception as e:
-        logger.error(f"Error en handle_referrals: {e}", exc_info=True)
+        logger.error("Error en handle_referrals: %s", e, exc_info=True)
         await query.edit_message_text(
             "❌ Error al cargar información de referidos.",
             reply_markup=back_to_menu(),
@@ -271,7 +315,7 @@ async def handle_copy_ref_code(update: Update, context: ContextTypes.DEFAULT_TYP
         )
 
     except Exception as e:
-        logger.error(f"Error en handle_copy_ref_code: {e}", exc_info=True)
+        logger.error("Error en handle_copy_ref_code: %s", e, exc_info=True)
         await update.message.reply_text(
             "❌ Error al copiar enlace.",
             reply_markup=main_menu(),
@@ -300,25 +344,18 @@ async def handle_exchange_text_input(update: Update, context: ContextTypes.DEFAU
     try:
         context.user_data["awaiting_exchange"] = False
         exchange_name = update.message.text.strip()
-        users_col = users_collection()
+        users_col = users_collection_async()
         user_id = update.effective_user.id
-        
-        loop = asyncio.get_event_loop()
-        user = await loop.run_in_executor(
-            None,
-            lambda: users_col.find_one({"user_id": user_id})
-        )
+
+        user = await users_col.find_one({"user_id": user_id}, {"_id": 1})
 
         if not user:
             await update.message.reply_text("❌ Usuario no encontrado.")
             return
 
-        await loop.run_in_executor(
-            None,
-            lambda: users_col.update_one(
-                {"user_id": user_id},
-                {"$set": {"exchange": exchange_name}}
-            )
+        await users_col.update_one(
+            {"user_id": user_id},
+            {"$set": {"exchange": exchange_name}}
         )
 
         await update.message.reply_text(
@@ -327,7 +364,7 @@ async def handle_exchange_text_input(update: Update, context: ContextTypes.DEFAU
         )
 
     except Exception as e:
-        logger.error(f"Error en handle_exchange_text: {e}", exc_info=True)
+        logger.error("Error en handle_exchange_text: %s", e, exc_info=True)
         await update.message.reply_text("❌ Error al registrar exchange.")
         context.user_data["awaiting_exchange"] = False
 
@@ -340,7 +377,7 @@ async def handle_view_signals(query, user, admin, users_col):
         user_id = user["user_id"]
         plan = PLAN_PREMIUM if admin else user.get("plan", PLAN_FREE)
 
-        if not admin and not (is_plan_active(user) or is_trial_active(user)):
+        if not admin and not has_active_access(user):
             await query.edit_message_text(
                 "⛔ Acceso expirado.",
                 reply_markup=back_to_menu(),
@@ -355,20 +392,26 @@ async def handle_view_signals(query, user, admin, users_col):
             )
             return
 
-        for base_signal in base_signals:
-            user_signal = generate_user_signal(base_signal, user_id)
-            await query.edit_message_text(
-                format_user_signal(user_signal),
-                reply_markup=back_to_menu(),
+        # Editar el mismo mensaje N veces solo dejaba visible la última
+        # señal: se envía un mensaje por señal, en orden, y solo el
+        # último lleva el teclado de volver al menú.
+        texts = [
+            format_user_signal(generate_user_signal(base_signal, user_id))
+            for base_signal in base_signals
+        ]
+        for i, text in enumerate(texts, start=1):
+            await query.message.reply_text(
+                text,
+                reply_markup=back_to_menu() if i == len(texts) else None,
             )
 
-        users_col.update_one(
+        run_in_background(users_col.update_one(
             {"user_id": user_id},
-            {"$set": update_timestamp(user)}
-        )
+            {"$set": update_timestamp()}
+        ))
 
     except Exception as e:
-        logger.error(f"Error en handle_view_signals: {e}", exc_info=True)
+        logger.error("Error en handle_view_signals: %s", e, exc_info=True)
         await query.edit_message_text(
             "❌ Error al obtener señales.",
             reply_markup=back_to_menu(),
@@ -402,11 +445,7 @@ async def handle_my_account(query, user, admin=False):
 
     if admin:
         message += "\n👑 PANEL ADMINISTRADOR\n"
-        keyboard = [
-            [InlineKeyboardButton("➕ Activar plan", callback_data="admin_activate_plan")],
-            [InlineKeyboardButton("⬅️ Volver", callback_data="back_menu")],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = _ADMIN_PANEL_KB
     else:
         reply_markup = back_to_menu()
 
@@ -432,7 +471,7 @@ async def handle_support(query):
 async def handle_admin_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         target_user_id_str = update.message.text.strip()
-        logger.info(f"[ADMIN] Recibido User ID: {target_user_id_str}")
+        logger.info("[ADMIN] Recibido User ID: %s", target_user_id_str)
         
         try:
             target_user_id = int(target_user_id_str)
@@ -446,13 +485,9 @@ async def handle_admin_text_input(update: Update, context: ContextTypes.DEFAULT_
             context.user_data["awaiting_user_id"] = False
             return
 
-        users_col = users_collection()
-        loop = asyncio.get_event_loop()
-        
-        target_user = await loop.run_in_executor(
-            None,
-            lambda: users_col.find_one({"user_id": target_user_id})
-        )
+        users_col = users_collection_async()
+
+        target_user = await users_col.find_one({"user_id": target_user_id}, {"_id": 1})
         
         if not target_user:
             await update.message.reply_text("❌ Usuario no encontrado en la base de datos.")
@@ -475,20 +510,45 @@ async def handle_admin_text_input(update: Update, context: ContextTypes.DEFAULT_
         )
 
     except Exception as e:
-        logger.error(f"[ADMIN] Error en handle_admin_text: {e}", exc_info=True)
+        logger.error("[ADMIN] Error en handle_admin_text: %s", e, exc_info=True)
         await update.message.reply_text("❌ Error procesando la solicitud.")
         context.user_data["awaiting_user_id"] = False
 
+# ======================================================
+# TABLAS DE DESPACHO DEL MENÚ
+# ======================================================
+
+_MENU_DISPATCH = {
+    "view_signals": lambda q, ctx, user, admin, col: handle_view_signals(q, user, admin, col),
+    "plans": lambda q, ctx, user, admin, col: handle_plans(q),
+    "my_account": lambda q, ctx, user, admin, col: handle_my_account(q, user, admin),
+    "referrals": lambda q, ctx, user, admin, col: handle_referrals(q, user),
+    "support": lambda q, ctx, user, admin, col: handle_support(q),
+    "register_exchange": _menu_register_exchange,
+    "back_menu": _menu_back,
+    "choose_plus_plan": _menu_choose_plan,
+    "choose_premium_plan": _menu_choose_plan,
+}
+
+# Solo accesibles si is_admin(user_id)
+_ADMIN_MENU_DISPATCH = {
+    "admin_panel": _menu_admin_panel,
+    "admin_activate_plan": _menu_admin_activate_plan,
+}
+
+# Patrón de los callbacks del menú, compilado una sola vez
+_MENU_PATTERN = re.compile(
+    "^(" + "|".join(map(re.escape, [*_MENU_DISPATCH, *_ADMIN_MENU_DISPATCH])) + ")$"
+)
+
 # ======================================================
 # REGISTRO DE HANDLERS
 # ======================================================
 
 def get_handlers():
     return [
-        CallbackQueryHandler(
-            handle_menu,
-            pattern="^(view_signals|plans|my_account|referrals|support|admin_panel|admin_activate_plan|register_exchange|back_menu|choose_plus_plan|choose_premium_plan)$"
-        ),
+        CommandHandler("start", handle_start),
+        CallbackQueryHandler(handle_menu, pattern=_MENU_PATTERN),
         CallbackQueryHandler(handle_copy_ref_code, pattern="^copy_ref_code$"),
         MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_messages),
           ]
@@ -2,10 +2,10 @@
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
 
-def main_menu():
-    """
-    Menú principal del bot.
-    """
+# Los teclados fijos se construyen una sola vez al importar el módulo
+# y se reutilizan en cada respuesta.
+
+def _build_main_menu():
     keyboard = [
         [InlineKeyboardButton("📊 Ver señales", callback_data="view_signals")],
         [
@@ -23,21 +23,41 @@ def main_menu():
     return InlineKeyboardMarkup(keyboard)
 
 
-def back_to_menu():
-    """
-    Botón para volver al menú principal.
-    """
+def _build_back_to_menu():
     return InlineKeyboardMarkup(
         [[InlineKeyboardButton("⬅️ Volver al menú", callback_data="back_menu")]]
     )
 
 
-def admin_menu():
-    """
-    Menú de administrador.
-    """
+def _build_admin_menu():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("➕ Activar plan PREMIUM", callback_data="admin_activate_plan")],
         [InlineKeyboardButton("📊 Estadísticas", callback_data="admin_stats")],
         [InlineKeyboardButton("⬅️ Volver", callback_data="back_menu")],
     ])
+
+
+MAIN_MENU = _build_main_menu()
+BACK_TO_MENU = _build_back_to_menu()
+ADMIN_MENU = _build_admin_menu()
+
+
+def main_menu():
+    """
+    Menú principal del bot.
+    """
+    return MAIN_MENU
+
+
+def back_to_menu():
+    """
+    Botón para volver al menú principal.
+    """
+    return BACK_TO_MENU
+
+
+def admin_menu():
+    """
+    Menú de administrador.
+    """
+    return ADMIN_MENU
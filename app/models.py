@@ -36,10 +36,9 @@ def new_user(
     }
 
 
-def update_timestamp(doc: Dict[str, Any]) -> Dict[str, Any]:
-    updated_doc = doc.copy()
-    updated_doc["updated_at"] = datetime.utcnow()
-    return updated_doc
+def update_timestamp(now: Optional[datetime] = None) -> Dict[str, Any]:
+    """Fragmento $set que solo toca updated_at (no el documento entero)."""
+    return {"updated_at": now or datetime.utcnow()}
 
 
 def activate_plan(user: Dict[str, Any], plan: str, days: int = 30) -> Dict[str, Any]:
@@ -52,19 +51,33 @@ def activate_plan(user: Dict[str, Any], plan: str, days: int = 30) -> Dict[str,
 
     user["plan"] = plan
     user["trial_end"] = None
-    return update_timestamp(user)
+    user.update(update_timestamp(now))
+    return user
 
 
-def is_trial_active(user: Dict[str, Any]) -> bool:
+# `now` permite reutilizar un único instante cuando se evalúan varias
+# condiciones seguidas. Se mantiene UTC naive: PyMongo devuelve las
+# fechas sin tzinfo y compararlas con un datetime aware lanza TypeError.
+def is_trial_active(user: Dict[str, Any], now: Optional[datetime] = None) -> bool:
     if user.get("trial_end") is None:
         return False
-    return user["trial_end"] >= datetime.utcnow()
+    return user["trial_end"] >= (now or datetime.utcnow())
 
 
-def is_plan_active(user: Dict[str, Any]) -> bool:
+def is_plan_active(user: Dict[str, Any], now: Optional[datetime] = None) -> bool:
     if user.get("plan_end") is None:
         return False
-    return user["plan_end"] >= datetime.utcnow()
+    return user["plan_end"] >= (now or datetime.utcnow())
+
+
+def has_active_access(user: Dict[str, Any], now: Optional[datetime] = None) -> bool:
+    """Plan o trial vigente, leyendo cada campo una sola vez."""
+    now = now or datetime.utcnow()
+    plan_end = user.get("plan_end")
+    trial_end = user.get("trial_end")
+    return (plan_end is not None and plan_end >= now) or (
+        trial_end is not None and trial_end >= now
+    )
 
 
 # =========================
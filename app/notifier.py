@@ -1,13 +1,16 @@
+import os
+import time
 import asyncio
 import logging
-from typing import List
+from itertools import islice
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 from telegram import Bot
+from telegram.error import RetryAfter, TimedOut
 from datetime import datetime
 
 from app.database import users_collection, signals_collection
 from app.plans import PLAN_FREE, PLAN_PLUS, PLAN_PREMIUM
-from app.config import is_admin
-from app.models import is_trial_active, is_plan_active
+from app.config import ADMIN_USER_IDS
 
 logger = logging.getLogger(__name__)
 
@@ -17,48 +20,129 @@ logger = logging.getLogger(__name__)
 
 ALERT_AUTO_DELETE_SECONDS = 8
 
+# Los planes cambian poco entre señales: la lista de elegibles por plan
+# se reutiliza durante este tiempo (o hasta invalidate_eligible_cache()).
+ELIGIBLE_CACHE_TTL_SECONDS = int(os.getenv("ELIGIBLE_CACHE_TTL_SECONDS", "60"))
+
+# Telegram limita a ~30 mensajes/s por bot: se deja margen
+PUSH_RATE_PER_SECOND = float(os.getenv("PUSH_RATE_PER_SECOND", "25"))
+# Envíos en vuelo simultáneos (el token bucket sigue marcando el ritmo)
+PUSH_CONCURRENCY = int(os.getenv("PUSH_CONCURRENCY", "25"))
+# Tamaño de lote al leer destinatarios: los envíos arrancan con el primero
+ELIGIBLE_BATCH_SIZE = int(os.getenv("ELIGIBLE_BATCH_SIZE", "1000"))
+
 # ======================================================
 # USUARIOS ELEGIBLES POR PLAN
 # ======================================================
 
-def _eligible_users_for_alert(signal_visibility: str) -> List[int]:
+_eligible_cache: Dict[str, Tuple[float, List[int]]] = {}
+
+
+def invalidate_eligible_cache():
+    """
+    Descarta las listas de elegibles cacheadas.
+    Llamar cuando cambia el plan o el acceso de algún usuario.
+    """
+    _eligible_cache.clear()
+
+
+async def _eligible_users_for_alert(signal_visibility: str) -> AsyncIterator[List[int]]:
+    """
+    Produce, por lotes, los usuarios que DEBEN recibir el push.
+    Con caché vigente se entrega la lista completa de una vez; si no,
+    los lotes se leen del cursor en un thread (el broadcast vive en el
+    loop del scanner, donde el cliente Motor del bot no sirve) y se
+    entregan según llegan, de modo que los envíos empiezan con el
+    primer lote. Al terminar, la lista queda cacheada.
     """
-    Retorna usuarios que DEBEN recibir el push.
+    cached = _eligible_cache.get(signal_visibility)
+    if cached and time.monotonic() - cached[0] < ELIGIBLE_CACHE_TTL_SECONDS:
+        yield cached[1]
+        return
+
+    eligible_users: List[int] = []
+    cursor = users_collection().find(
+        _eligible_query(signal_visibility), {"user_id": 1, "_id": 0}
+    ).batch_size(ELIGIBLE_BATCH_SIZE)
+    try:
+        while batch := await asyncio.to_thread(_next_batch, cursor):
+            eligible_users.extend(batch)
+            yield batch
+    finally:
+        cursor.close()
+
+    # 👑 ADMIN: SOLO PREMIUM (ids fijos de config, sin consulta)
+    if signal_visibility == PLAN_PREMIUM and ADMIN_USER_IDS:
+        admin_batch = list(ADMIN_USER_IDS)
+        eligible_users.extend(admin_batch)
+        yield admin_batch
+
+    _eligible_cache[signal_visibility] = (time.monotonic(), eligible_users)
+
+
+def _next_batch(cursor) -> List[int]:
+    return [user["user_id"] for user in islice(cursor, ELIGIBLE_BATCH_SIZE)]
+
+
+def _eligible_query(signal_visibility: str) -> dict:
+    """
+    Consulta MongoDB de los usuarios (no admin) que DEBEN recibir el push.
     Reglas:
     - Cada usuario SOLO recibe push de su plan
-    - Admin SOLO recibe PREMIUM
+    - Admin SOLO recibe PREMIUM (se añade aparte, ver arriba)
+    El filtrado (plan + acceso vigente) se hace en MongoDB.
     """
 
-    users_col = users_collection()
-    eligible_users: List[int] = []
+    now = datetime.utcnow()
 
-    users = users_col.find(
-        {},
-        {"user_id": 1, "plan": 1, "trial_end": 1, "plan_end": 1}
-    )
+    # Usuarios sin campo "plan" cuentan como FREE
+    if signal_visibility == PLAN_FREE:
+        plan_filter = {"$in": [PLAN_FREE, None]}
+    else:
+        plan_filter = signal_visibility
 
-    for user in users:
-        user_id = user.get("user_id")
-        user_plan = user.get("plan", PLAN_FREE)
+    # 👤 USUARIOS NORMALES: SOLO SU PLAN y con plan o trial vigente
+    return {
+        "plan": plan_filter,
+        "user_id": {"$nin": list(ADMIN_USER_IDS)},
+        "$or": [
+            {"plan_end": {"$gte": now}},
+            {"trial_end": {"$gte": now}},
+        ],
+    }
 
-        admin = is_admin(user_id)
-        has_access = is_plan_active(user) or is_trial_active(user)
+# ======================================================
+# RATE LIMIT DE PUSH (TOKEN BUCKET)
+# ======================================================
 
-        # ❌ Sin acceso y no admin → fuera
-        if not has_access and not admin:
-            continue
+class TokenBucket:
+    """
+    Token bucket async: como máximo `rate` envíos por segundo,
+    con ráfagas de hasta `rate` envíos.
+    """
 
-        # 👑 ADMIN: SOLO PREMIUM
-        if admin:
-            if signal_visibility == PLAN_PREMIUM:
-                eligible_users.append(user_id)
-            continue
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.capacity = rate
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
 
-        # 👤 USUARIOS NORMALES: SOLO SU PLAN
-        if user_plan == signal_visibility:
-            eligible_users.append(user_id)
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity,
+                    self._tokens + (now - self._updated) * self.rate,
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
 
-    return eligible_users
+_push_bucket = TokenBucket(PUSH_RATE_PER_SECOND)
 
 # ======================================================
 # AUTO DELETE
@@ -75,23 +159,88 @@ async def _auto_delete(bot: Bot, chat_id: int, message_id: int):
 # PUSH DE NUEVA SEÑAL (SIN BLOQUEO)
 # ======================================================
 
+async def _send_alert(bot: Bot, user_id: int, text: str) -> bool:
+    """
+    Envía un push respetando el token bucket.
+    Ante 429 (RetryAfter) espera lo indicado por Telegram y reintenta;
+    ante TimedOut reintenta una vez. En el último intento no se espera:
+    no habría reintento y solo retendría el slot de envío.
+    """
+    attempts = 2
+    for attempt in range(1, attempts + 1):
+        await _push_bucket.acquire()
+        try:
+            msg = await bot.send_message(
+                chat_id=user_id,
+                text=text,
+                parse_mode="Markdown",
+            )
+        except RetryAfter as e:
+            if attempt == attempts:
+                logger.warning(f"⏳ Rate limit de Telegram en el último intento a {user_id}")
+                break
+            logger.warning(f"⏳ Rate limit de Telegram, esperando {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+        except TimedOut:
+            logger.debug(f"⌛ Timeout enviando push a {user_id}, reintentando")
+        except Exception as e:
+            logger.warning(f"⚠️ Push fallido a {user_id}: {e}")
+            return False
+        else:
+            asyncio.create_task(_auto_delete(bot, user_id, msg.message_id))
+            return True
+
+    logger.warning(f"⚠️ Push fallido a {user_id} tras reintento")
+    return False
+
+# ======================================================
+# COLA DE BROADCAST
+# ======================================================
+# El scanner solo encola la visibilidad de la señal; un worker en el
+# mismo event loop resuelve destinatarios y envía al ritmo de Telegram.
+
+_broadcast_queue: Optional[asyncio.Queue] = None
+_broadcast_worker_task: Optional[asyncio.Task] = None
+
+
+def _ensure_broadcast_worker(bot: Bot) -> asyncio.Queue:
+    """Arranca (una vez) el worker de broadcast en el loop actual."""
+    global _broadcast_queue, _broadcast_worker_task
+    if _broadcast_worker_task is None or _broadcast_worker_task.done():
+        _broadcast_queue = asyncio.Queue()
+        _broadcast_worker_task = asyncio.create_task(
+            _broadcast_worker(bot, _broadcast_queue)
+        )
+    return _broadcast_queue
+
+
+async def _broadcast_worker(bot: Bot, queue: asyncio.Queue):
+    while True:
+        signal_visibility = await queue.get()
+        try:
+            await _broadcast_signal_alert(bot, signal_visibility)
+        except Exception:
+            logger.error("❌ Error en broadcast de push", exc_info=True)
+        finally:
+            queue.task_done()
+
+
 async def notify_new_signal_alert(
     bot: Bot,
     signal_visibility: str,
     **kwargs,
 ):
     """
-    Envía push inmediatamente cuando hay señal.
+    Encola el push de una nueva señal y retorna sin esperar los envíos.
     Filtrado SOLO por plan exacto.
     """
+    _ensure_broadcast_worker(bot).put_nowait(signal_visibility)
 
-    user_ids = _eligible_users_for_alert(signal_visibility)
 
-    if not user_ids:
-        logger.warning(
-            f"📭 Push NO enviado: sin usuarios para plan {signal_visibility}"
-        )
-        return
+async def _broadcast_signal_alert(bot: Bot, signal_visibility: str):
+    """
+    Envía el push de nueva señal a todos los usuarios del plan.
+    """
 
     alert_text = (
         "📢 *NUEVA SEÑAL DISPONIBLE*\n\n"
@@ -99,22 +248,44 @@ async def notify_new_signal_alert(
         "⏳ Tiempo limitado."
     )
 
+    # Productor: lotes del cursor → cola acotada.
+    # Consumidores: PUSH_CONCURRENCY envíos en vuelo a la vez.
+    pending: asyncio.Queue = asyncio.Queue(maxsize=ELIGIBLE_BATCH_SIZE)
     sent = 0
+    total = 0
 
-    for user_id in user_ids:
-        try:
-            msg = await bot.send_message(
-                chat_id=user_id,
-                text=alert_text,
-                parse_mode="Markdown",
-            )
-            asyncio.create_task(_auto_delete(bot, user_id, msg.message_id))
-            sent += 1
-        except Exception as e:
-            logger.warning(f"⚠️ Push fallido a {user_id}: {e}")
+    async def _sender():
+        nonlocal sent
+        while True:
+            user_id = await pending.get()
+            try:
+                if await _send_alert(bot, user_id, alert_text):
+                    sent += 1
+            except Exception:
+                logger.error(f"❌ Error enviando push a {user_id}", exc_info=True)
+            finally:
+                pending.task_done()
+
+    senders = [asyncio.create_task(_sender()) for _ in range(PUSH_CONCURRENCY)]
+    try:
+        async for batch in _eligible_users_for_alert(signal_visibility):
+            total += len(batch)
+            for user_id in batch:
+                await pending.put(user_id)
+        await pending.join()
+    finally:
+        for task in senders:
+            task.cancel()
+        await asyncio.gather(*senders, return_exceptions=True)
+
+    if not total:
+        logger.warning(
+            f"📭 Push NO enviado: sin usuarios para plan {signal_visibility}"
+        )
+        return
 
     logger.info(
-        f"📨 Push enviado ({signal_visibility}): {sent}/{len(user_ids)} usuarios"
+        f"📨 Push enviado ({signal_visibility}): {sent}/{total} usuarios"
     )
 
 # ======================================================
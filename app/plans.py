@@ -1,11 +1,13 @@
 # app/plans.py - VERSIÓN CORREGIDA
 
-from datetime import datetime, timedelta
+from datetime import datetime
 from typing import Optional
 import logging
 
+from pymongo import ReturnDocument
+
 from app.database import users_collection
-from app.models import activate_plan, is_plan_active, is_trial_active, update_timestamp
+from app.models import has_active_access, is_plan_active, is_trial_active
 
 logger = logging.getLogger(__name__)
 
@@ -45,7 +47,7 @@ def has_access(user: dict) -> bool:
     Retorna True si el usuario puede ver señales
     (plan activo o trial activo).
     """
-    return is_plan_active(user) or is_trial_active(user)
+    return has_active_access(user)
 
 
 def plan_status(user: dict) -> dict:
@@ -54,14 +56,14 @@ def plan_status(user: dict) -> dict:
     """
     now = datetime.utcnow()
 
-    if is_plan_active(user):
+    if is_plan_active(user, now):
         return {
             "plan": user["plan"],
             "status": "active",
             "expires": user["plan_end"],
         }
 
-    if is_trial_active(user):
+    if is_trial_active(user, now):
         return {
             "plan": PLAN_FREE,
             "status": "trial",
@@ -83,51 +85,76 @@ def activate_plus(user_id: int, days: int = PLAN_DURATION_DAYS) -> bool:
     """
     Activa o extiende PLAN PLUS.
     """
-    try:
-        user = get_user(user_id)
-        if not user:
-            logger.warning(f"Usuario {user_id} no encontrado al activar PLUS")
-            return False
-
-        user = activate_plan(user, PLAN_PLUS, days)
-        save_user(user)
-        
-        # ✅ REGISTRAR REFERIDO (IMPORTANTE)
-        _register_referral_after_activation(user_id, PLAN_PLUS)
-        
-        logger.info(f"✅ Plan PLUS activado para usuario {user_id}")
-        return True
-        
-    except Exception as e:
-        logger.error(f"❌ Error activando PLUS para {user_id}: {e}", exc_info=True)
-        return False
+    return _activate(user_id, PLAN_PLUS, days)
 
 
 def activate_premium(user_id: int, days: int = PLAN_DURATION_DAYS) -> bool:
     """
     Activa o extiende PLAN PREMIUM.
     """
+    return _activate(user_id, PLAN_PREMIUM, days)
+
+
+def plan_extension_fields(days: int) -> dict:
+    """
+    Campos de un $set (update con pipeline) que extienden plan_end:
+    si el plan sigue vigente se suman `days` a su vencimiento; si no,
+    se cuentan desde ahora. Se evalúa en el servidor ($$NOW).
+    """
+    return {
+        "updated_at": "$$NOW",
+        "plan_end": {"$add": [
+            {"$max": [{"$ifNull": ["$plan_end", "$$NOW"]}, "$$NOW"]},
+            days * 24 * 60 * 60 * 1000,
+        ]},
+    }
+
+
+def _activate(user_id: int, plan: str, days: int) -> bool:
+    """
+    Activa o extiende `plan` en una sola operación atómica.
+    El documento actualizado se reutiliza para registrar el referido
+    sin releer al usuario.
+    """
+    label = get_plan_name(plan)
     try:
-        user = get_user(user_id)
+        user = users_collection().find_one_and_update(
+            {"user_id": user_id},
+            [{"$set": {
+                "plan": plan,
+                "trial_end": None,
+                **plan_extension_fields(days),
+            }}],
+            projection={"_id": 0, "user_id": 1, "referred_by": 1},
+            return_document=ReturnDocument.AFTER,
+        )
         if not user:
-            logger.warning(f"Usuario {user_id} no encontrado al activar PREMIUM")
+            logger.warning(f"Usuario {user_id} no encontrado al activar {label}")
             return False
 
-        user = activate_plan(user, PLAN_PREMIUM, days)
-        save_user(user)
-        
+        _invalidate_push_recipients()
+
         # ✅ REGISTRAR REFERIDO (IMPORTANTE)
-        _register_referral_after_activation(user_id, PLAN_PREMIUM)
+        _register_referral_after_activation(user_id, plan, user)
         
-        logger.info(f"✅ Plan PREMIUM activado para usuario {user_id}")
+        logger.info(f"✅ Plan {label} activado para usuario {user_id}")
         return True
         
     except Exception as e:
-        logger.error(f"❌ Error activando PREMIUM para {user_id}: {e}", exc_info=True)
+        logger.error(f"❌ Error activando {label} para {user_id}: {e}", exc_info=True)
         return False
 
 
-def _register_referral_after_activation(user_id: int, plan: str):
+def _invalidate_push_recipients():
+    """
+    Invalida la caché de destinatarios de push del notifier.
+    Importa aquí para evitar dependencias circulares.
+    """
+    from app.notifier import invalidate_eligible_cache
+    invalidate_eligible_cache()
+
+
+def _register_referral_after_activation(user_id: int, plan: str, user: Optional[dict] = None):
     """
     Llama al sistema de referidos después de activar un plan.
     Importa aquí para evitar dependencias circulares.
@@ -135,7 +162,7 @@ def _register_referral_after_activation(user_id: int, plan: str):
     try:
         # Importación condicional para evitar problemas de importación circular
         from app.referrals import register_valid_referral
-        success = register_valid_referral(user_id, plan)
+        success = register_valid_referral(user_id, plan, referred_user=user)
         if success:
             logger.info(f"✅ Referido registrado para {user_id} con plan {plan}")
         else:
@@ -150,26 +177,23 @@ def _register_referral_after_activation(user_id: int, plan: str):
 # EXPIRACIONES AUTOMÁTICAS
 # =========================
 
-def expire_plans():
+def expire_plans() -> int:
     """
-    Revisa y expira planes vencidos.
+    Revisa y expira planes vencidos en una sola actualización.
     Debe ejecutarse periódicamente (scheduler).
+    Retorna el número de usuarios pasados a FREE.
     """
     now = datetime.utcnow()
-    users_col = users_collection()
-
-    expired_users = users_col.find({
-        "plan_end": {"$lt": now}
-    })
-
-    for user in expired_users:
-        user["plan"] = PLAN_FREE
-        user["plan_end"] = None
-        user = update_timestamp(user)
-        users_col.update_one(
-            {"user_id": user["user_id"]},
-            {"$set": user},
-        )
+
+    result = users_collection().update_many(
+        {"plan_end": {"$lt": now}, "plan": {"$ne": PLAN_FREE}},
+        {"$set": {"plan": PLAN_FREE, "plan_end": None, "updated_at": now}},
+    )
+
+    if result.modified_count:
+        _invalidate_push_recipients()
+        logger.info(f"📋 {result.modified_count} planes expirados actualizados a FREE")
+    return result.modified_count
 
 
 # =========================
@@ -181,19 +205,14 @@ def extend_current_plan(user_id: int, days: int = PLAN_DURATION_DAYS) -> bool:
     Extiende el plan actual del usuario.
     """
     try:
-        user = get_user(user_id)
-        if not user or not is_plan_active(user):
+        # Solo planes vigentes; la suma se hace en el servidor y solo
+        # se escriben plan_end y updated_at
+        result = users_collection().update_one(
+            {"user_id": user_id, "plan_end": {"$gte": datetime.utcnow()}},
+            [{"$set": plan_extension_fields(days)}],
+        )
+        if not result.modified_count:
             return False
-
-        # Calcular nueva fecha de expiración
-        if user.get("plan_end"):
-            new_end = user["plan_end"] + timedelta(days=days)
-        else:
-            new_end = datetime.utcnow() + timedelta(days=days)
-        
-        user["plan_end"] = new_end
-        user = update_timestamp(user)
-        save_user(user)
         
         logger.info(f"✅ Plan extendido {days} días para usuario {user_id}")
         return True
@@ -4,16 +4,19 @@ import logging
 from typing import Optional, Dict, List
 from datetime import datetime
 
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
 from app.database import users_collection, referrals_collection
 from app.plans import (
-    activate_plus,
-    activate_premium,
-    extend_current_plan,
+    plan_extension_fields,
     PLAN_FREE,
     PLAN_PLUS,
     PLAN_PREMIUM,
 )
-from app.models import update_timestamp, is_plan_active
+from app.notifier import invalidate_eligible_cache
+from app.models import is_plan_active
+from app.config import BOT_NAME
 
 logger = logging.getLogger(__name__)
 
@@ -25,9 +28,12 @@ logger = logging.getLogger(__name__)
 def register_valid_referral(
     referred_user_id: int,
     activated_plan: str,
+    referred_user: Optional[Dict] = None,
 ) -> bool:
     """
     Registra un referido válido cuando un usuario activa un plan.
+    `referred_user` evita releer al usuario si el llamador ya lo tiene
+    (basta con los campos user_id y referred_by).
     Retorna True si se registró correctamente.
     """
     try:
@@ -35,7 +41,10 @@ def register_valid_referral(
         refs_col = referrals_collection()
 
         # 1. Obtener usuario referido
-        referred_user = users_col.find_one({"user_id": referred_user_id})
+        if referred_user is None:
+            referred_user = users_col.find_one(
+                {"user_id": referred_user_id}, {"_id": 0, "referred_by": 1}
+            )
         if not referred_user:
             logger.warning(f"Usuario referido {referred_user_id} no encontrado")
             return False
@@ -52,16 +61,16 @@ def register_valid_referral(
             return False
 
         # 4. Verificar que el referidor exista
-        referrer = users_col.find_one({"user_id": referrer_id})
+        referrer = users_col.find_one({"user_id": referrer_id}, {"_id": 1})
         if not referrer:
             logger.warning(f"Referidor {referrer_id} no encontrado")
             return False
 
         # 5. Verificar que no sea doble conteo (mismo referido para el mismo referidor)
-        existing = refs_col.find_one({
-            "referrer_id": referrer_id,
-            "referred_id": referred_user_id
-        })
+        existing = refs_col.find_one(
+            {"referrer_id": referrer_id, "referred_id": referred_user_id},
+            {"_id": 1},
+        )
         if existing:
             logger.debug(f"Referido {referred_user_id} ya registrado para {referrer_id}")
             return False
@@ -74,15 +83,21 @@ def register_valid_referral(
             "activated_at": datetime.utcnow(),
             "reward_applied": False  # Para tracking de recompensas
         }
-        refs_col.insert_one(ref_doc)
+        try:
+            refs_col.insert_one(ref_doc)
+        except DuplicateKeyError:
+            # Otra activación simultánea ya lo registró (índice único)
+            logger.debug(f"Referido {referred_user_id} ya registrado para {referrer_id}")
+            return False
 
         # 7. Actualizar contadores en el usuario referidor
+        # (una sola operación: $inc + fecha del servidor)
         if activated_plan == PLAN_PLUS:
             users_col.update_one(
                 {"user_id": referrer_id},
                 {
                     "$inc": {"ref_plus_valid": 1, "ref_plus_total": 1},
-                    "$set": update_timestamp(referrer)
+                    "$currentDate": {"updated_at": True},
                 }
             )
         elif activated_plan == PLAN_PREMIUM:
@@ -90,7 +105,7 @@ def register_valid_referral(
                 {"user_id": referrer_id},
                 {
                     "$inc": {"ref_premium_valid": 1, "ref_premium_total": 1},
-                    "$set": update_timestamp(referrer)
+                    "$currentDate": {"updated_at": True},
                 }
             )
 
@@ -127,19 +142,19 @@ def get_user_referral_stats(user_id: int) -> Optional[Dict]:
         # 2. Obtener código de referencia
         ref_code = user.get("ref_code", f"ref_{user_id}")
         
-        # 3. Calcular referidos TOTALES (históricos)
-        total_referred = refs_col.count_documents({"referrer_id": user_id})
-        
-        # 4. Calcular referidos por plan (históricos)
-        plus_referred = refs_col.count_documents({
-            "referrer_id": user_id,
-            "activated_plan": PLAN_PLUS
-        })
-        
-        premium_referred = refs_col.count_documents({
-            "referrer_id": user_id,
-            "activated_plan": PLAN_PREMIUM
-        })
+        # 3. Contar referidos históricos (total / plus / premium) en una
+        #    sola agregación en vez de tres count_documents
+        counts = next(refs_col.aggregate(_referrer_pipeline(
+            user_id,
+            {"$facet": {
+                "total": [{"$count": "n"}],
+                "plus": [{"$match": {"activated_plan": PLAN_PLUS}}, {"$count": "n"}],
+                "premium": [{"$match": {"activated_plan": PLAN_PREMIUM}}, {"$count": "n"}],
+            }},
+        )), {})
+        total_referred = _facet_count(counts, "total")
+        plus_referred = _facet_count(counts, "plus")
+        premium_referred = _facet_count(counts, "premium")
         
         # 5. Obtener contadores ACTUALES (para recompensas)
         current_plus = user.get("ref_plus_valid", 0)
@@ -164,10 +179,26 @@ def get_user_referral_stats(user_id: int) -> Optional[Dict]:
         return _get_empty_stats(user_id)
 
 
+def _referrer_pipeline(referrer_id: int, *stages: Dict) -> List[Dict]:
+    """
+    Construye un pipeline sobre `referrals` que SIEMPRE empieza filtrando
+    por referrer_id (indexado). Cualquier $lookup/$unwind posterior opera
+    solo sobre los referidos de ese usuario y no sobre toda la colección.
+    """
+    return [{"$match": {"referrer_id": referrer_id}}, *stages]
+
+
+def _facet_count(facets: Dict, key: str) -> int:
+    """Extrae el resultado de un $count dentro de un $facet (vacío = 0)"""
+    bucket = facets.get(key) or []
+    return bucket[0]["n"] if bucket else 0
+
+
 def _get_empty_stats(user_id: int) -> Dict:
     """Retorna estadísticas vacías para usuario no encontrado"""
+    ref_code = f"ref_{user_id}"
     return {
-        "ref_code": f"ref_{user_id}",
+        "ref_code": ref_code,
         "total_referred": 0,
         "plus_referred": 0,
         "premium_referred": 0,
@@ -210,92 +241,84 @@ def _calculate_pending_rewards(user: Dict) -> List[str]:
 # EVALUACIÓN DE RECOMPENSAS (VERSIÓN MEJORADA)
 # =========================
 
+# Reglas por plan actual del referidor, en orden de prioridad:
+# (contador, referidos necesarios, plan resultante, descripción)
+# Si el plan resultante es el actual, la recompensa extiende el plan.
+REWARD_RULES = {
+    PLAN_FREE: (
+        ("ref_premium_valid", 5, PLAN_PREMIUM, "recibió PREMIUM por 5 referidos premium"),
+        ("ref_plus_valid", 5, PLAN_PLUS, "recibió PLUS por 5 referidos plus"),
+    ),
+    PLAN_PLUS: (
+        ("ref_premium_valid", 5, PLAN_PREMIUM, "ascendió a PREMIUM por 5 referidos premium"),
+        ("ref_plus_valid", 5, PLAN_PLUS, "extendió PLUS por 5 referidos plus"),
+    ),
+    PLAN_PREMIUM: (
+        ("ref_premium_valid", 5, PLAN_PREMIUM, "extendió PREMIUM por 5 referidos premium"),
+        ("ref_plus_valid", 10, PLAN_PREMIUM, "extendió PREMIUM por 10 referidos plus"),
+    ),
+}
+
+REWARD_DAYS = 30
+
+
 def check_ref_rewards(referrer_id: int) -> bool:
     """
     Evalúa y aplica recompensas automáticas.
+    Cada recompensa es un único find_one_and_update: la condición
+    (plan vigente + contador suficiente) va en el filtro, así que
+    descontar referidos y extender el plan ocurren juntos o no ocurren.
     Retorna True si se aplicó alguna recompensa.
     """
     try:
         users_col = users_collection()
-        referrer = users_col.find_one({"user_id": referrer_id})
+        referrer = users_col.find_one(
+            {"user_id": referrer_id},
+            {"_id": 0, "plan": 1, "plan_end": 1, "ref_plus_valid": 1, "ref_premium_valid": 1},
+        )
         
         if not referrer or not is_plan_active(referrer):
             return False
         
         plan = referrer.get("plan", PLAN_FREE)
-        plus_count = referrer.get("ref_plus_valid", 0)
-        premium_count = referrer.get("ref_premium_valid", 0)
-        
-        reward_applied = False
-        
-        # USUARIO FREE
-        if plan == PLAN_FREE:
-            if premium_count >= 5:
-                if activate_premium(referrer_id):
-                    users_col.update_one(
-                        {"user_id": referrer_id},
-                        {"$inc": {"ref_premium_valid": -5}}
-                    )
-                    reward_applied = True
-                    logger.info(f"🎁 Recompensa: {referrer_id} recibió PREMIUM por 5 referidos premium")
-            
-            elif plus_count >= 5:
-                if activate_plus(referrer_id):
-                    users_col.update_one(
-                        {"user_id": referrer_id},
-                        {"$inc": {"ref_plus_valid": -5}}
-                    )
-                    reward_applied = True
-                    logger.info(f"🎁 Recompensa: {referrer_id} recibió PLUS por 5 referidos plus")
         
-        # USUARIO PLUS
-        elif plan == PLAN_PLUS:
-            if premium_count >= 5:
-                if activate_premium(referrer_id):
-                    users_col.update_one(
-                        {"user_id": referrer_id},
-                        {"$inc": {"ref_premium_valid": -5}}
-                    )
-                    reward_applied = True
-                    logger.info(f"🎁 Recompensa: {referrer_id} ascendió a PREMIUM por 5 referidos premium")
-            
-            elif plus_count >= 5:
-                if extend_current_plan(referrer_id, days=30):
-                    users_col.update_one(
-                        {"user_id": referrer_id},
-                        {"$inc": {"ref_plus_valid": -5}}
-                    )
-                    reward_applied = True
-                    logger.info(f"🎁 Recompensa: {referrer_id} extendió PLUS por 5 referidos plus")
-        
-        # USUARIO PREMIUM
-        elif plan == PLAN_PREMIUM:
-            if premium_count >= 5:
-                if extend_current_plan(referrer_id, days=30):
-                    users_col.update_one(
-                        {"user_id": referrer_id},
-                        {"$inc": {"ref_premium_valid": -5}}
-                    )
-                    reward_applied = True
-                    logger.info(f"🎁 Recompensa: {referrer_id} extendió PREMIUM por 5 referidos premium")
-            
-            elif plus_count >= 10:
-                if extend_current_plan(referrer_id, days=30):
-                    users_col.update_one(
-                        {"user_id": referrer_id},
-                        {"$inc": {"ref_plus_valid": -10}}
-                    )
-                    reward_applied = True
-                    logger.info(f"🎁 Recompensa: {referrer_id} extendió PREMIUM por 10 referidos plus")
-        
-        if reward_applied:
-            # Actualizar timestamp
-            users_col.update_one(
-                {"user_id": referrer_id},
-                {"$set": update_timestamp(referrer)}
+        for counter, required, new_plan, description in REWARD_RULES.get(plan, ()):
+            if referrer.get(counter, 0) < required:
+                continue
+
+            fields = {
+                "plan": new_plan,
+                counter: {"$subtract": [f"${counter}", required]},
+                **plan_extension_fields(REWARD_DAYS),
+            }
+            if new_plan != plan:
+                fields["trial_end"] = None
+
+            updated = users_col.find_one_and_update(
+                {
+                    "user_id": referrer_id,
+                    "plan": referrer.get("plan"),
+                    "plan_end": {"$gte": datetime.utcnow()},
+                    counter: {"$gte": required},
+                },
+                [{"$set": fields}],
+                projection={"_id": 0, "user_id": 1, "referred_by": 1},
+                return_document=ReturnDocument.AFTER,
             )
+            if not updated:
+                # Otro proceso consumió los referidos o cambió el plan
+                return False
+
+            invalidate_eligible_cache()
+            if new_plan != plan:
+                # Igual que una activación normal: cuenta como referido
+                # válido para quien refirió a este usuario
+                register_valid_referral(referrer_id, new_plan, referred_user=updated)
+
+            logger.info(f"🎁 Recompensa: {referrer_id} {description}")
+            return True
         
-        return reward_applied
+        return False
         
     except Exception as e:
         logger.error(f"❌ Error en check_ref_rewards para {referrer_id}: {e}", exc_info=True)
@@ -306,16 +329,18 @@ def check_ref_rewards(referrer_id: int) -> bool:
 # FUNCIONES AUXILIARES
 # =========================
 
+def build_referral_link(ref_code: str) -> str:
+    """Construye el enlace de referido a partir de un ref_code ya conocido"""
+    return f"https://t.me/{BOT_NAME}?start={ref_code}"
+
+
 def get_referral_link(user_id: int) -> str:
     """Genera enlace de referido para un usuario"""
     users_col = users_collection()
-    user = users_col.find_one({"user_id": user_id})
-    
-    if not user:
-        return f"https://t.me/HADES_FT_BOT?start=ref_{user_id}"
+    user = users_col.find_one({"user_id": user_id}, {"ref_code": 1, "_id": 0})
     
-    ref_code = user.get("ref_code", f"ref_{user_id}")
-    return f"https://t.me/HADES_FT_BOT?start={ref_code}"
+    ref_code = (user or {}).get("ref_code") or f"ref_{user_id}"
+    return build_referral_link(ref_code)
 
 
 def get_referral_summary(user_id: int) -> Dict:
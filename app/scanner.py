@@ -2,20 +2,21 @@
 
 import os
 import time
+import heapq
 import logging
 import asyncio
 from datetime import datetime, timedelta
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 
-import requests
-import pandas as pd
+import numpy as np
 from telegram import Bot
 
-from app.strategy import mtf_strategy
+from app.binance import get_http_client
+from app.strategy import Bars, mtf_strategy, warmup as warmup_strategy
 from app.signals import create_base_signal, telegram_signal_blocked
 from app.plans import PLAN_FREE, PLAN_PLUS, PLAN_PREMIUM
 from app.notifier import notify_new_signal_alert
-from app.database import signals_collection
+from app.database import signals_collection, exists_with_hint, SIGNALS_DEDUP_INDEX
 
 # ======================================================
 # LOGGING
@@ -25,53 +26,74 @@ logger = logging.getLogger(__name__)
 # ======================================================
 # CONFIGURACIÓN GENERAL
 # ======================================================
-BINANCE_FUTURES_API = "https://fapi.binance.com"
-
 SCAN_INTERVAL_SECONDS = 300  # Intervalo cambiado a 5 minutos
 MIN_QUOTE_VOLUME = int(os.getenv("MIN_QUOTE_VOLUME", "50000000"))  # 50M USDT
 DEDUP_MINUTES = int(os.getenv("DEDUP_MINUTES", "10"))
 REQUEST_DELAY = float(os.getenv("REQUEST_DELAY", "0.2"))
-REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "15"))
+# Símbolos analizados a la vez (el RateLimiter sigue marcando el ritmo)
+SCAN_CONCURRENCY = int(os.getenv("SCAN_CONCURRENCY", "15"))
+# Universo de símbolos: se refresca cada pocos ciclos de escaneo
+SYMBOLS_CACHE_TTL_SECONDS = int(os.getenv("SYMBOLS_CACHE_TTL_SECONDS", "900"))
 
 # ======================================================
 # RATE LIMITER
 # ======================================================
 class RateLimiter:
+    """
+    Espacia las peticiones al menos `delay` segundos.
+    Cada llamada reserva su turno bajo el lock y duerme fuera de él,
+    así las esperas no bloquean el loop ni serializan a los demás.
+    """
+
     def __init__(self, delay: float):
         self.delay = delay
-        self.last_request = 0.0
+        self._next_allowed = 0.0
+        self._lock = asyncio.Lock()
 
-    def wait(self):
-        elapsed = time.time() - self.last_request
-        if elapsed < self.delay:
-            time.sleep(self.delay - elapsed)
-        self.last_request = time.time()
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self._next_allowed - now)
+            self._next_allowed = max(now, self._next_allowed) + self.delay
+        if wait:
+            await asyncio.sleep(wait)
 
 rate_limiter = RateLimiter(REQUEST_DELAY)
 
 # ======================================================
 # DATA FETCH
 # ======================================================
-def get_klines(symbol: str, interval: str, limit: int = 200) -> pd.DataFrame:
-    rate_limiter.wait()
-    url = f"{BINANCE_FUTURES_API}/fapi/v1/klines"
+_symbols_cache: Tuple[float, List[str]] = (0.0, [])
+_symbols_lock = asyncio.Lock()
+
+async def get_klines(symbol: str, interval: str, limit: int = 200) -> Bars:
+    await rate_limiter.wait()
     params = {"symbol": symbol, "interval": interval, "limit": limit}
-    response = requests.get(url, params=params, timeout=REQUEST_TIMEOUT)
+    response = await get_http_client().get("/fapi/v1/klines", params=params)
     response.raise_for_status()
-    df = pd.DataFrame(
-        response.json(),
-        columns=[
-            "open_time", "open", "high", "low", "close", "volume",
-            "close_time", "quote_volume", "trades",
-            "taker_buy_base", "taker_buy_quote", "ignore"
-        ],
-    )
-    return df[["open", "high", "low", "close", "volume"]].astype(float)
-
-def get_active_futures_symbols() -> List[str]:
-    rate_limiter.wait()
-    url = f"{BINANCE_FUTURES_API}/fapi/v1/ticker/24hr"
-    response = requests.get(url, timeout=REQUEST_TIMEOUT)
+    # Solo columnas 1..5 (open, high, low, close, volume), directo a float64;
+    # traspuesto para que cada columna quede contigua para los kernels
+    data = np.array([row[1:6] for row in response.json()], dtype=np.float64)
+    return Bars(*np.ascontiguousarray(data.T))
+
+async def get_active_futures_symbols() -> List[str]:
+    """
+    Símbolos USDT con volumen suficiente. El ticker 24h es pesado y el
+    universo cambia despacio: se reutiliza durante SYMBOLS_CACHE_TTL_SECONDS.
+    """
+    global _symbols_cache
+    async with _symbols_lock:
+        cached_at, symbols = _symbols_cache
+        if symbols and time.monotonic() - cached_at < SYMBOLS_CACHE_TTL_SECONDS:
+            return symbols
+
+        symbols = await _fetch_active_futures_symbols()
+        _symbols_cache = (time.monotonic(), symbols)
+        return symbols
+
+async def _fetch_active_futures_symbols() -> List[str]:
+    await rate_limiter.wait()
+    response = await get_http_client().get("/fapi/v1/ticker/24hr")
     response.raise_for_status()
     symbols = [
         item["symbol"]
@@ -87,19 +109,106 @@ def get_active_futures_symbols() -> List[str]:
 # ======================================================
 def recent_duplicate_exists(symbol: str, direction: str, visibility: str) -> bool:
     since = datetime.utcnow() - timedelta(minutes=DEDUP_MINUTES)
-    exists = signals_collection().find_one(
+    exists = exists_with_hint(
+        signals_collection(),
         {
             "symbol": symbol,
             "direction": direction,
             "visibility": visibility,
             "created_at": {"$gte": since},
-        }
-    ) is not None
+        },
+        SIGNALS_DEDUP_INDEX,
+    )
 
     if exists:
         logger.info(f"♻️ Duplicado reciente detectado: {symbol} {direction} ({visibility})")
     return exists
 
+# ======================================================
+# ANÁLISIS POR SÍMBOLO
+# ======================================================
+async def process_symbol(semaphore: asyncio.Semaphore, symbol: str) -> Optional[Dict]:
+    """
+    Descarga las tres temporalidades de un símbolo y aplica la estrategia.
+    Retorna el candidato o None (sin setup o error de datos).
+    """
+    async with semaphore:
+        try:
+            bars_1h, bars_15m, bars_5m = await asyncio.gather(
+                get_klines(symbol, "1h"),
+                get_klines(symbol, "15m"),
+                get_klines(symbol, "5m"),
+            )
+        except Exception as e:
+            logger.debug(f"⚠️ Error procesando {symbol}: {e}")
+            return None
+
+    # Fuera del loop: los kernels numba sueltan el GIL y las descargas
+    # de los demás símbolos siguen avanzando mientras se calcula
+    try:
+        result = await asyncio.to_thread(mtf_strategy, bars_1h, bars_15m, bars_5m)
+    except Exception as e:
+        logger.debug(f"⚠️ Error procesando {symbol}: {e}")
+        return None
+
+    if result:
+        result["symbol"] = symbol
+    return result
+
+# ======================================================
+# DESPACHO DE SEÑALES
+# ======================================================
+async def dispatch_signal(bot: Bot, signal: Dict, visibility: str, medal: str):
+    """
+    Crea la señal base de un candidato del top y encola su push.
+    """
+    symbol = signal["symbol"]
+    direction = signal["direction"]
+    entry_price = float(signal["entry_price"])
+    score = signal.get("score", 0)
+
+    if recent_duplicate_exists(symbol, direction, visibility):
+        return
+
+    if direction == "LONG":
+        stop_loss = round(entry_price * 0.99, 4)
+        take_profits = [
+            round(entry_price * 1.01, 4),
+            round(entry_price * 1.02, 4),
+        ]
+    else:
+        stop_loss = round(entry_price * 1.01, 4)
+        take_profits = [
+            round(entry_price * 0.99, 4),
+            round(entry_price * 0.98, 4),
+        ]
+
+    base_signal = await create_base_signal(
+        symbol=symbol,
+        direction=direction,
+        entry_price=entry_price,
+        stop_loss=stop_loss,
+        take_profits=take_profits,
+        timeframes=["5M", "15M", "1H"],
+        visibility=visibility,
+        score=score,
+        components=signal.get("components", []),
+        current_price=signal.get("last_close"),
+    )
+
+    try:
+        await notify_new_signal_alert(
+            bot,
+            visibility,
+            base_signal=base_signal
+        )
+    except Exception as e:
+        logger.error(f"⚠️ Error notificando señal: {e}")
+
+    logger.info(
+        f"✅ {medal} | {symbol} {direction} | score={score} | plan={visibility}"
+    )
+
 # ======================================================
 # SCANNER PRINCIPAL (CONTROLADO POR TELEGRAM)
 # ======================================================
@@ -114,24 +223,12 @@ async def scan_market_async(bot: Bot):
                 await asyncio.sleep(SCAN_INTERVAL_SECONDS)
                 continue
 
-            symbols = get_active_futures_symbols()
-            candidates: List[Dict] = []
-
-            for symbol in symbols:
-                try:
-                    df_1h = get_klines(symbol, "1h")
-                    df_15m = get_klines(symbol, "15m")
-                    df_5m = get_klines(symbol, "5m")
-
-                    result = mtf_strategy(df_1h, df_15m, df_5m)
-                    if result:
-                        result["symbol"] = symbol
-                        candidates.append(result)
-
-                    await asyncio.sleep(0.05)
-
-                except Exception as e:
-                    logger.debug(f"⚠️ Error procesando {symbol}: {e}")
+            symbols = await get_active_futures_symbols()
+            semaphore = asyncio.Semaphore(SCAN_CONCURRENCY)
+            results = await asyncio.gather(
+                *(process_symbol(semaphore, symbol) for symbol in symbols)
+            )
+            candidates: List[Dict] = [r for r in results if r]
 
             if len(candidates) < 3:
                 logger.info("📭 No hay oportunidades fuertes en este ciclo")
@@ -141,8 +238,7 @@ async def scan_market_async(bot: Bot):
             # ==================================================
             # RANKING GLOBAL — TOP 3 DEL MERCADO
             # ==================================================
-            candidates.sort(key=lambda x: x["score"], reverse=True)
-            top_3 = candidates[:3]
+            top_3 = heapq.nlargest(3, candidates, key=lambda x: x["score"])
 
             plan_map = [
                 (PLAN_PREMIUM, "🥇 ORO"),
@@ -150,53 +246,20 @@ async def scan_market_async(bot: Bot):
                 (PLAN_FREE, "🥉 BRONCE"),
             ]
 
-            for idx, signal in enumerate(top_3):
-                visibility, medal = plan_map[idx]
-                symbol = signal["symbol"]
-                direction = signal["direction"]
-                entry_price = float(signal["entry_price"])
-                score = signal.get("score", 0)
-
-                if recent_duplicate_exists(symbol, direction, visibility):
-                    continue
-
-                if direction == "LONG":
-                    stop_loss = round(entry_price * 0.99, 4)
-                    take_profits = [
-                        round(entry_price * 1.01, 4),
-                        round(entry_price * 1.02, 4),
-                    ]
-                else:
-                    stop_loss = round(entry_price * 1.01, 4)
-                    take_profits = [
-                        round(entry_price * 0.99, 4),
-                        round(entry_price * 0.98, 4),
-                    ]
-
-                base_signal = create_base_signal(
-                    symbol=symbol,
-                    direction=direction,
-                    entry_price=entry_price,
-                    stop_loss=stop_loss,
-                    take_profits=take_profits,
-                    timeframes=["5M", "15M", "1H"],
-                    visibility=visibility,
-                    score=score,
-                    components=signal.get("components", [])
-                )
-
-                try:
-                    await notify_new_signal_alert(
-                        bot,
-                        visibility,
-                        base_signal=base_signal
+            # Las tres señales (una por plan) se despachan a la vez
+            results = await asyncio.gather(
+                *(
+                    dispatch_signal(bot, signal, visibility, medal)
+                    for signal, (visibility, medal) in zip(top_3, plan_map)
+                ),
+                return_exceptions=True,
+            )
+            for signal, result in zip(top_3, results):
+                if isinstance(result, Exception):
+                    logger.error(
+                        f"❌ Error despachando señal {signal['symbol']}: {result}",
+                        exc_info=result,
                     )
-                except Exception as e:
-                    logger.error(f"⚠️ Error notificando señal: {e}")
-
-                logger.info(
-                    f"✅ {medal} | {symbol} {direction} | score={score} | plan={visibility}"
-                )
 
             await asyncio.sleep(SCAN_INTERVAL_SECONDS)
 
@@ -206,6 +269,7 @@ async def scan_market_async(bot: Bot):
 
 def scan_market(bot: Bot):
     logger.info("🚀 Iniciando scanner en thread separado")
+    warmup_strategy()
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     loop.run_until_complete(scan_market_async(bot))
@@ -3,10 +3,8 @@
 import os
 import asyncio
 import logging
-from datetime import datetime, timedelta
 
-from app.database import users_collection, signals_collection, user_signals_collection
-from app.plans import PLAN_FREE
+from app.plans import expire_plans
 
 logger = logging.getLogger(__name__)
 
@@ -15,7 +13,6 @@ logger = logging.getLogger(__name__)
 # ======================================================
 
 CHECK_INTERVAL_SECONDS = int(os.getenv("SCHEDULER_CHECK_INTERVAL", "300"))  # 5 min por defecto
-BATCH_SIZE = int(os.getenv("SCHEDULER_BATCH_SIZE", "100"))  # Usuarios por batch
 
 # ======================================================
 # TAREA: EXPIRACIÓN DE PLANES (CORREGIDA SIN BOT)
@@ -23,76 +20,24 @@ BATCH_SIZE = int(os.getenv("SCHEDULER_BATCH_SIZE", "100"))  # Usuarios por batch
 
 async def check_expired_plans() -> int:
     """
-    Revisa planes vencidos y actualiza a FREE.
+    Revisa planes vencidos y actualiza a FREE (un único update_many).
     Retorna el número de usuarios procesados.
     """
-    users_col = users_collection()
-    now = datetime.utcnow()
-    
-    # Consulta optimizada: solo usuarios con plan activo que hayan expirado
-    expired_users = users_col.find(
-        {
-            "plan_end": {"$lt": now, "$ne": None},
-            "plan": {"$ne": PLAN_FREE}  # Solo usuarios con plan activo
-        }
-    ).limit(BATCH_SIZE)
-    
-    processed_count = 0
-    
-    for user in expired_users:
-        try:
-            user_id = user["user_id"]
-            
-            # Actualizar a FREE
-            result = users_col.update_one(
-                {"user_id": user_id},
-                {
-                    "$set": {
-                        "plan": PLAN_FREE,
-                        "plan_end": None,
-                        "updated_at": now,
-                    }
-                }
-            )
-            
-            if result.modified_count > 0:
-                logger.info(f"📋 Plan expirado para usuario {user_id}, actualizado a FREE")
-                processed_count += 1
-                
-        except Exception as e:
-            logger.error(f"❌ Error procesando usuario {user.get('user_id', 'unknown')}: {e}")
-    
-    return processed_count
+    # PyMongo es bloqueante: se ejecuta fuera del event loop del bot.
+    # expire_plans ya invalida la caché de destinatarios de push.
+    return await asyncio.to_thread(expire_plans)
 
 # ======================================================
 # TAREAS DE MANTENIMIENTO (NO REQUIEREN BOT)
 # ======================================================
-
-async def cleanup_old_signals():
-    """Limpia señales antiguas de la base de datos."""
-    try:
-        # Señales base: mantener 7 días
-        cutoff_date = datetime.utcnow() - timedelta(days=7)
-        
-        result_base = signals_collection().delete_many({
-            "created_at": {"$lt": cutoff_date}
-        })
-        
-        # Señales de usuario: mantener 3 días
-        cutoff_user = datetime.utcnow() - timedelta(days=3)
-        result_user = user_signals_collection().delete_many({
-            "created_at": {"$lt": cutoff_user}
-        })
-        
-        if result_base.deleted_count > 0 or result_user.deleted_count > 0:
-            logger.info(f"🧹 Limpieza: {result_base.deleted_count} señales base, "
-                       f"{result_user.deleted_count} señales usuario")
-            
-    except Exception as e:
-        logger.error(f"❌ Error en cleanup_old_signals: {e}")
+# La limpieza de señales antiguas la hacen los índices TTL
+# (ver database.INDEXES).
 
 async def check_database_health():
     """Verifica la salud de la base de datos."""
+    return await asyncio.to_thread(_check_database_health)
+
+def _check_database_health() -> bool:
     try:
         from app.database import get_client
         
@@ -124,8 +69,8 @@ async def check_database_health():
 # ======================================================
 
 async def scheduler_loop():
-    """Loop principal del scheduler - SIN USAR BOT para evitar errores de event loop."""
-    logger.info("⏰ Scheduler iniciado correctamente (modo seguro)")
+    """Loop principal del scheduler - corre como tarea en el event loop del bot."""
+    logger.info("⏰ Scheduler iniciado correctamente")
     
     iteration = 0
     errors_in_row = 0
@@ -138,11 +83,7 @@ async def scheduler_loop():
             if processed > 0:
                 logger.info(f"📋 Procesados {processed} planes expirados (actualizados a FREE)")
             
-            # Tarea 2: Cada hora: limpiar señales antiguas (5 min * 12 = 60 min)
-            if iteration % 12 == 0:
-                await cleanup_old_signals()
-            
-            # Tarea 3: Cada 6 horas: verificar salud de base de datos (5 min * 72 = 6 horas)
+            # Tarea 2: Cada 6 horas: verificar salud de base de datos (5 min * 72 = 6 horas)
             if iteration % 72 == 0:
                 await check_database_health()
             
@@ -1,32 +1,40 @@
 # app/signals.py
 
 import os
-import time
 import logging
 import secrets
 import hashlib
-import random
 from datetime import datetime, timedelta
 from typing import List, Dict, Optional
 
-import requests
+import httpx
+import numpy as np
 import pytz
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 
+from app.binance import get_http_client
 from app.models import new_signal
 from app.plans import PLAN_FREE, PLAN_PREMIUM
-from app.config import is_admin
-from app.database import signals_collection, user_signals_collection, users_collection
+from app.config import is_admin, ADMIN_USER_IDS
+from app.database import (
+    signals_collection,
+    user_signals_collection,
+    users_collection,
+    SIGNALS_DEDUP_INDEX,
+    SIGNALS_SYMBOL_INDEX,
+    exists_with_hint,
+)
 
 logger = logging.getLogger(__name__)
 
 # ======================================================
 # CONFIGURACIÓN GLOBAL
 # ======================================================
-BINANCE_FUTURES_API = os.getenv("BINANCE_FUTURES_API", "https://fapi.binance.com")
 MAX_SIGNALS_PER_QUERY = int(os.getenv("MAX_SIGNALS_PER_QUERY", "10"))
 BINANCE_MAX_RETRIES = int(os.getenv("BINANCE_MAX_RETRIES", "3"))
 BINANCE_RETRY_DELAY = float(os.getenv("BINANCE_RETRY_DELAY", "1.0"))
 USER_TIMEZONE = os.getenv("USER_TIMEZONE", "America/Havana")
+_TZ = pytz.timezone(USER_TIMEZONE)
 
 LEVERAGE_PROFILES = {
     "conservador": "5x-10x",
@@ -56,21 +64,21 @@ def calculate_entry_zone(entry: float, pct: float = 0.0015):
     high = round(entry * (1 + pct), 4)
     return low, high
 
-def get_current_price(symbol: str) -> float:
-    url = f"{BINANCE_FUTURES_API}/fapi/v1/ticker/price"
-    for attempt in range(BINANCE_MAX_RETRIES):
-        try:
-            r = requests.get(url, params={"symbol": symbol}, timeout=10)
-            r.raise_for_status()
-            return float(r.json()["price"])
-        except Exception:
-            if attempt == BINANCE_MAX_RETRIES - 1:
-                raise
-            time.sleep(BINANCE_RETRY_DELAY)
-
-def estimate_minutes_to_entry(symbol: str, entry_zone: Dict[str, float], timeframes: List[str]) -> Dict[str, int]:
+@retry(
+    retry=retry_if_exception_type(httpx.HTTPError),
+    wait=wait_exponential_jitter(initial=BINANCE_RETRY_DELAY, max=4),
+    stop=stop_after_attempt(BINANCE_MAX_RETRIES),
+    reraise=True,
+)
+async def get_current_price(symbol: str) -> float:
+    r = await get_http_client().get(
+        "/fapi/v1/ticker/price", params={"symbol": symbol}, timeout=10
+    )
+    r.raise_for_status()
+    return float(r.json()["price"])
+
+def estimate_minutes_to_entry(current_price: float, entry_zone: Dict[str, float], timeframes: List[str]) -> Dict[str, int]:
     try:
-        current_price = get_current_price(symbol)
         zone_mid = (entry_zone["low"] + entry_zone["high"]) / 2
 
         if entry_zone["low"] <= current_price <= entry_zone["high"]:
@@ -96,59 +104,96 @@ def estimate_minutes_to_entry(symbol: str, entry_zone: Dict[str, float], timefra
             "max": int(minutes_estimated * 1.4),
         }
     except Exception as e:
-        logger.warning(f"Fallback estimate_minutes_to_entry: {e}")
-        base = calculate_signal_validity(timeframes)
-        return {"min": max(1, int(base * 0.5)), "max": int(base * 1.5)}
+        return _fallback_estimate(timeframes, e)
+
+def _fallback_estimate(timeframes: List[str], error: Exception) -> Dict[str, int]:
+    logger.warning(f"Fallback estimate_minutes_to_entry: {error}")
+    base = calculate_signal_validity(timeframes)
+    return {"min": max(1, int(base * 0.5)), "max": int(base * 1.5)}
 
+async def _estimate_entry(
+    symbol: str,
+    current_price: Optional[float],
+    entry_zone: Dict[str, float],
+    timeframes: List[str],
+) -> Dict[str, int]:
+    """Estimación de entrada; solo consulta el ticker si no se pasó precio."""
+    if current_price is None:
+        try:
+            current_price = await get_current_price(symbol)
+        except Exception as e:
+            return _fallback_estimate(timeframes, e)
+    return estimate_minutes_to_entry(current_price, entry_zone, timeframes)
+
+# Comprobaciones de existencia: count_documents(limit=1) sobre el índice
+# compuesto no materializa ningún documento.
 def recent_duplicate_exists(symbol: str, direction: str, visibility: str) -> bool:
     since = datetime.utcnow() - timedelta(minutes=DEDUP_MINUTES)
-    return signals_collection().find_one({
+    return exists_with_hint(signals_collection(), {
         "symbol": symbol,
         "direction": direction,
         "visibility": visibility,
         "created_at": {"$gte": since},
-    }) is not None
+    }, SIGNALS_DEDUP_INDEX)
 
 def telegram_signal_blocked(symbol: Optional[str] = None) -> bool:
     since = datetime.utcnow() - timedelta(minutes=TELEGRAM_SIGNAL_COOLDOWN_MINUTES)
     query = {"created_at": {"$gte": since}}
     if symbol:
         query["symbol"] = symbol
-    return signals_collection().find_one(query, sort=[("created_at", -1)]) is not None
+        return exists_with_hint(signals_collection(), query, SIGNALS_SYMBOL_INDEX)
+    return signals_collection().count_documents(query, limit=1) > 0
 
 # ======================================================
 # GENERAR SEÑALES POR PLAN
 # ======================================================
 
 def generate_user_signal_for_plan(base_signal: Dict):
+    """
+    Crea la señal personalizada de cada usuario del plan (y admins) en
+    lote: una consulta de destinatarios, una de señales ya vigentes y un
+    único insert_many, en vez de dos operaciones por usuario.
+    """
     visibility = base_signal.get("visibility", PLAN_FREE)
+    now = datetime.utcnow()
+    admin_ids = list(ADMIN_USER_IDS)
+
+    # Usuarios sin campo "plan" cuentan como FREE
+    plan_filter = {"$in": [PLAN_FREE, None]} if visibility == PLAN_FREE else visibility
+
+    user_ids = [
+        user["user_id"]
+        for user in users_collection().find(
+            {"$and": [
+                {"$or": [{"plan": plan_filter}, {"user_id": {"$in": admin_ids}}]},
+                {"$or": [{"plan_end": None}, {"plan_end": {"$gte": now}}]},
+            ]},
+            {"user_id": 1, "_id": 0},
+        )
+    ]
+    if not user_ids:
+        return
 
-    for user in users_collection().find({}):
-        user_id = user.get("user_id")
-        user_plan = user.get("plan", PLAN_FREE)
-        plan_end = user.get("plan_end")
-        admin = is_admin(user_id)
-
-        if plan_end and plan_end < datetime.utcnow():
-            continue
-
-        if admin or user_plan == visibility:
-            # Verificar si ya existe señal vigente para este usuario y símbolo
-            existing = user_signals_collection().find_one({
-                "user_id": user_id,
-                "symbol": base_signal["symbol"],
-                "telegram_valid_until": {"$gt": datetime.utcnow()}
-            })
-            if existing:
-                continue  # No crear nueva señal, ID ya asignado
+    # Usuarios que ya tienen señal vigente de este símbolo: el ID no cambia
+    existing = set(user_signals_collection().distinct("user_id", {
+        "user_id": {"$in": user_ids},
+        "symbol": base_signal["symbol"],
+        "telegram_valid_until": {"$gt": now},
+    }))
 
-            generate_user_signal(base_signal, user_id)
+    docs = [
+        build_user_signal(base_signal, user_id)
+        for user_id in user_ids
+        if user_id not in existing
+    ]
+    if docs:
+        user_signals_collection().insert_many(docs, ordered=False)
 
 # ======================================================
 # CREAR SEÑAL BASE
 # ======================================================
 
-def create_base_signal(
+async def create_base_signal(
     symbol: str,
     direction: str,
     entry_price: float,
@@ -157,8 +202,13 @@ def create_base_signal(
     timeframes: List[str],
     visibility: str,
     score: Optional[float] = None,
-    components: Optional[List[str]] = None
+    components: Optional[List[str]] = None,
+    current_price: Optional[float] = None,
 ) -> Dict:
+    """
+    Crea y guarda la señal base. `current_price` (p. ej. el último cierre
+    de las velas ya descargadas) evita consultar el ticker de Binance.
+    """
 
     # Bloqueo de creación: no crear nueva señal si el mismo par está bloqueado
     if telegram_signal_blocked(symbol):
@@ -166,7 +216,7 @@ def create_base_signal(
         return {}
 
     zone_low, zone_high = calculate_entry_zone(entry_price)
-    estimated_minutes = estimate_minutes_to_entry(symbol, {"low": zone_low, "high": zone_high}, timeframes)
+    estimated_minutes = await _estimate_entry(symbol, current_price, {"low": zone_low, "high": zone_high}, timeframes)
 
     signal = new_signal(
         symbol=symbol,
@@ -181,27 +231,16 @@ def create_base_signal(
         score=score
     )
 
+    # Documento completo antes de insertar: una sola escritura
     now = datetime.utcnow()
-    inserted_id = signals_collection().insert_one(signal).inserted_id
-
-    signals_collection().update_one(
-        {"_id": inserted_id},
-        {"$set": {
-            "created_at": now,
-            "valid_until": now + timedelta(minutes=calculate_signal_validity(timeframes)),
-            "telegram_valid_until": now + timedelta(minutes=TELEGRAM_SIGNAL_COOLDOWN_MINUTES),
-            "entry_zone": {"low": zone_low, "high": zone_high},
-            "estimated_entry_minutes": estimated_minutes,
-        }}
-    )
-
-    signal["_id"] = inserted_id
     signal["created_at"] = now
     signal["valid_until"] = now + timedelta(minutes=calculate_signal_validity(timeframes))
     signal["telegram_valid_until"] = now + timedelta(minutes=TELEGRAM_SIGNAL_COOLDOWN_MINUTES)
     signal["entry_zone"] = {"low": zone_low, "high": zone_high}
     signal["estimated_entry_minutes"] = estimated_minutes
 
+    signal["_id"] = signals_collection().insert_one(signal).inserted_id
+
     generate_user_signal_for_plan(signal)
     return signal
 
@@ -219,16 +258,22 @@ def generate_user_signal(base_signal: Dict, user_id: int) -> Dict:
     if existing:
         return existing  # Retornar señal existente, ID no cambia
 
-    rnd = random.Random(
-        int(hashlib.sha256(f"{base_signal['_id']}_{user_id}".encode()).hexdigest(), 16)
+    user_signal = build_user_signal(base_signal, user_id)
+    user_signals_collection().insert_one(user_signal)
+    return user_signal
+
+
+def build_user_signal(base_signal: Dict, user_id: int) -> Dict:
+    """Documento de señal personalizado (precios deterministas por señal y usuario)."""
+    seed = int.from_bytes(
+        hashlib.blake2b(f"{base_signal['_id']}_{user_id}".encode(), digest_size=8).digest(),
+        "little",
     )
+    rng = np.random.default_rng(seed)
 
     direction = base_signal["direction"].upper()
     entry = base_signal["entry_price"]
 
-    def vary(val, pct):
-        return round(rnd.uniform(val * (1 - pct), val * (1 + pct)), 4)
-
     if direction == "LONG":
         sl_base = entry * 0.99
         tp1_base = entry * 1.01
@@ -238,17 +283,25 @@ def generate_user_signal(base_signal: Dict, user_id: int) -> Dict:
         tp1_base = entry * 0.99
         tp2_base = entry * 0.98
 
+    # Todas las variaciones en una sola muestra: entrada (±0.05%) y
+    # SL/TP1/TP2 (±0.1%) por cada perfil de apalancamiento
+    n_profiles = len(LEVERAGE_PROFILES)
+    bases = np.array([entry] + [sl_base, tp1_base, tp2_base] * n_profiles)
+    pcts = np.array([0.0005] + [0.001] * (3 * n_profiles))
+    samples = np.round(rng.uniform(bases * (1 - pcts), bases * (1 + pcts)), 4).tolist()
+    levels = iter(samples[1:])
+
     user_signal = {
         "user_id": user_id,
         "signal_id": str(base_signal["_id"]),
         "symbol": base_signal["symbol"],
         "direction": direction,
-        "entry_price": vary(entry, 0.0005),
+        "entry_price": samples[0],
         "entry_zone": dict(zip(["low", "high"], calculate_entry_zone(entry))),
         "profiles": {
             p: {
-                "stop_loss": vary(sl_base, 0.001),
-                "take_profits": [vary(tp1_base, 0.001), vary(tp2_base, 0.001)]
+                "stop_loss": next(levels),
+                "take_profits": [next(levels), next(levels)]
             }
             for p in LEVERAGE_PROFILES
         },
@@ -260,8 +313,6 @@ def generate_user_signal(base_signal: Dict, user_id: int) -> Dict:
         "fingerprint": secrets.token_hex(4),
         "visibility": base_signal["visibility"],
     }
-
-    user_signals_collection().insert_one(user_signal)
     return user_signal
 
 # ======================================================
@@ -269,34 +320,34 @@ def generate_user_signal(base_signal: Dict, user_id: int) -> Dict:
 # ======================================================
 
 def format_user_signal(user_signal: Dict) -> str:
-    tz = pytz.timezone(USER_TIMEZONE)
-    start = user_signal["created_at"].astimezone(tz).strftime("%H:%M")
-    end = user_signal["telegram_valid_until"].astimezone(tz).strftime("%H:%M")
+    start = user_signal["created_at"].astimezone(_TZ).strftime("%H:%M")
+    end = user_signal["telegram_valid_until"].astimezone(_TZ).strftime("%H:%M")
+    profiles = user_signal["profiles"]
 
-    text = (
-        f"📊 NUEVA SEÑAL – FUTUROS USDT\n\n"
+    parts = [
+        "📊 NUEVA SEÑAL – FUTUROS USDT\n\n"
         f"🏷️ PLAN: {user_signal['visibility'].upper()}\n\n"
         f"Par: {user_signal['symbol']}\n"
         f"Dirección: {user_signal['direction']}\n"
         f"Entrada base: {user_signal['entry_price']}\n\n"
-        f"Margen: ISOLATED\n"
+        "Margen: ISOLATED\n"
         f"Timeframes: {' / '.join(user_signal['timeframes'])}\n\n"
-    )
+    ]
 
-    for profile in ["conservador", "moderado", "agresivo"]:
-        p = user_signal["profiles"][profile]
-        text += (
+    for profile, leverage in LEVERAGE_PROFILES.items():
+        p = profiles[profile]
+        parts.append(
             "━━━━━━━━━━━━━━━━━━\n"
             f"{profile.upper()}\n"
             f"SL: {p['stop_loss']}\n"
             f"TP1: {p['take_profits'][0]}\n"
             f"TP2: {p['take_profits'][1]}\n"
-            f"Apalancamiento: {LEVERAGE_PROFILES[profile]}\n\n"
+            f"Apalancamiento: {leverage}\n\n"
         )
 
-    text += f"⏳ Activa: {start} → {end}\n"
-    text += f"🔐 ID: {user_signal['fingerprint']}\n"
-    return text
+    parts.append(f"⏳ Activa: {start} → {end}\n")
+    parts.append(f"🔐 ID: {user_signal['fingerprint']}\n")
+    return "".join(parts)
 
 # ======================================================
 # OBTENER SEÑALES USUARIO
@@ -28,23 +28,19 @@ def _start_of_month(dt: datetime) -> datetime:
 # ======================================================
 
 def _calculate_stats(from_date: datetime) -> Dict:
-    results = signal_results_collection().find(
-        {"evaluated_at": {"$gte": from_date}}
-    )
-
-    total = 0
-    won = 0
-    lost = 0
-    expired = 0
-
-    for r in results:
-        total += 1
-        if r["result"] == "won":
-            won += 1
-        elif r["result"] == "lost":
-            lost += 1
-        elif r["result"] == "expired":
-            expired += 1
+    # Conteo por resultado en el servidor: solo viajan unos pocos buckets
+    buckets = {
+        bucket["_id"]: bucket["count"]
+        for bucket in signal_results_collection().aggregate([
+            {"$match": {"evaluated_at": {"$gte": from_date}}},
+            {"$group": {"_id": "$result", "count": {"$sum": 1}}},
+        ])
+    }
+
+    total = sum(buckets.values())
+    won = buckets.get("won", 0)
+    lost = buckets.get("lost", 0)
+    expired = buckets.get("expired", 0)
 
     effective_trades = won + lost
     winrate = round((won / effective_trades) * 100, 2) if effective_trades > 0 else 0.0
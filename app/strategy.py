@@ -1,6 +1,13 @@
-import pandas as pd
-from typing import Optional, Dict
-import ta
+import numpy as np
+from typing import Optional, Dict, NamedTuple, Tuple
+
+try:
+    from numba import njit
+except ImportError:  # numba es opcional: sin él, los kernels corren en Python
+    def njit(*args, **kwargs):
+        def decorator(fn):
+            return fn
+        return decorator
 
 # =========================
 # CONFIGURACIÓN
@@ -22,43 +29,159 @@ MAX_SCORE = 100
 # INDICADORES
 # =========================
 
-def add_indicators(df: pd.DataFrame) -> pd.DataFrame:
-    df = df.copy()
-
-    df["ema_200"] = ta.trend.ema_indicator(df["close"], EMA_TREND)
-
-    bb = ta.volatility.BollingerBands(
-        close=df["close"],
-        window=BB_PERIOD,
-        window_dev=BB_STD,
-    )
-    df["bb_high"] = bb.bollinger_hband()
-    df["bb_low"] = bb.bollinger_lband()
-    df["bb_mid"] = bb.bollinger_mavg()
-    df["bb_width"] = (df["bb_high"] - df["bb_low"]) / df["bb_mid"]
-
-    df["adx"] = ta.trend.adx(
-        df["high"], df["low"], df["close"], ADX_PERIOD
+class Bars(NamedTuple):
+    """Velas OHLCV como columnas float64 contiguas (una por campo)."""
+    open: np.ndarray
+    high: np.ndarray
+    low: np.ndarray
+    close: np.ndarray
+    volume: np.ndarray
+
+
+class LastBar(NamedTuple):
+    """Valores de la última vela como floats (sin Series de pandas)."""
+    close: float
+    volume: float
+    ema_200: float
+    bb_high: float
+    bb_low: float
+    bb_mid: float
+    adx: float
+    vol_ma: float
+
+
+@njit(cache=True, nogil=True)
+def _ema_kernel(values: np.ndarray, alpha: float) -> float:
+    ema = values[0]
+    for i in range(1, values.shape[0]):
+        ema = alpha * values[i] + (1.0 - alpha) * ema
+    return ema
+
+
+def _ema_last(values: np.ndarray, window: int) -> float:
+    """
+    Último valor de la EMA (misma definición que ta: ewm adjust=False,
+    NaN si no hay `window` velas).
+    """
+    if values.shape[0] < window:
+        return float("nan")
+    return float(_ema_kernel(values, 2.0 / (window + 1)))
+
+
+@njit(cache=True, nogil=True, error_model="numpy")
+def _adx_kernel(high: np.ndarray, low: np.ndarray, close: np.ndarray, n: int) -> float:
+    """
+    Último valor del ADX de Wilder, reproduciendo ta.trend.adx (0.10.x):
+    - TR, +DM y -DM se suavizan con sm = sm - sm/n + x, sembrando con la
+      suma de las primeras n velas (TR desde la vela 0, DM desde la 1)
+    - ADX = media de los n primeros DX y luego (adx*(n-1) + dx)/n
+    - Como en ta, el DX de la última vela no entra en el último ADX
+    """
+    size = close.shape[0]
+
+    trs = high[0] - low[0]
+    dip = 0.0
+    din = 0.0
+    for j in range(1, n + 1):
+        if j < n:
+            trs += max(high[j], close[j - 1]) - min(low[j], close[j - 1])
+        up = high[j] - high[j - 1]
+        down = low[j - 1] - low[j]
+        if up > down and up > 0:
+            dip += up
+        if down > up and down > 0:
+            din += down
+
+    dx_sum = 0.0
+    adx = np.nan
+    for i in range(size - n):
+        if i > 0:
+            k = n + i
+            trs = trs - trs / n + max(high[k], close[k - 1]) - min(low[k], close[k - 1])
+            up = high[k] - high[k - 1]
+            down = low[k - 1] - low[k]
+            dip = dip - dip / n + (up if up > down and up > 0 else 0.0)
+            din = din - din / n + (down if down > up and down > 0 else 0.0)
+
+        di_pos = 100.0 * dip / trs
+        di_neg = 100.0 * din / trs
+        dx = 100.0 * abs((di_pos - di_neg) / (di_pos + di_neg))
+
+        if i < n:
+            dx_sum += dx
+            if i == n - 1:
+                adx = dx_sum / n
+        else:
+            adx = (adx * (n - 1) + dx) / n
+    return adx
+
+
+def _adx_last(high: np.ndarray, low: np.ndarray, close: np.ndarray, window: int) -> float:
+    """Último ADX, NaN si no hay al menos 2*window velas."""
+    if close.shape[0] < 2 * window:
+        return float("nan")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return float(_adx_kernel(high, low, close, window))
+
+
+def warmup():
+    """
+    Compila los kernels numba por adelantado (o los carga de la caché)
+    para que el primer escaneo no pague la compilación.
+    """
+    # Serie con rango y movimiento: evita 0/0 en el DX (warnings sin numba)
+    close = 100.0 + np.sin(np.arange(2 * ADX_PERIOD, dtype=np.float64))
+    _ema_kernel(close, 0.5)
+    _adx_kernel(close + 1.0, close - 1.0, close, ADX_PERIOD)
+
+
+def _window_mean_std(values: np.ndarray, window: int) -> Tuple[float, float]:
+    """Media y desviación poblacional de las últimas `window` velas."""
+    if values.shape[0] < window:
+        return float("nan"), float("nan")
+    tail = values[-window:]
+    return float(tail.mean()), float(tail.std())
+
+
+def last_indicators(bars: Bars, setup: bool = True) -> LastBar:
+    """
+    Calcula solo los valores de la última vela. EMA, Bollinger (std
+    poblacional, como ta) y media de volumen salen de NumPy; el ADX de
+    _adx_kernel. Con setup=False se omiten Bollinger y la media de
+    volumen (quedan en NaN): 1H y 15M solo filtran por EMA y ADX.
+    """
+    close = bars.close
+    volume = bars.volume
+
+    if setup:
+        bb_mid, bb_std = _window_mean_std(close, BB_PERIOD)
+        vol_ma, _ = _window_mean_std(volume, 20)
+    else:
+        bb_mid = bb_std = vol_ma = float("nan")
+    adx = _adx_last(bars.high, bars.low, close, ADX_PERIOD)
+
+    return LastBar(
+        close=float(close[-1]),
+        volume=float(volume[-1]),
+        ema_200=_ema_last(close, EMA_TREND),
+        bb_high=bb_mid + BB_STD * bb_std,
+        bb_low=bb_mid - BB_STD * bb_std,
+        bb_mid=bb_mid,
+        adx=adx,
+        vol_ma=vol_ma,
     )
 
-    df["vol_ma"] = df["volume"].rolling(20).mean()
-
-    return df
-
 # =========================
 # FILTROS DE MERCADO
 # =========================
 
-def market_has_strength(df: pd.DataFrame) -> bool:
-    last = df.iloc[-1]
-    return last["adx"] >= ADX_MIN_TREND
-
-def trend_direction(df: pd.DataFrame) -> Optional[str]:
-    last = df.iloc[-1]
+def market_has_strength(last: LastBar) -> bool:
+    return last.adx >= ADX_MIN_TREND
 
-    if last["close"] > last["ema_200"]:
+def trend_direction(last: LastBar) -> Optional[str]:
+    if last.close > last.ema_200:
         return "LONG"
-    elif last["close"] < last["ema_200"]:
+    elif last.close < last.ema_200:
         return "SHORT"
     return None
 
@@ -66,35 +189,31 @@ def trend_direction(df: pd.DataFrame) -> Optional[str]:
 # SETUP ROMPIMIENTO
 # =========================
 
-def breakout_confirmation(df: pd.DataFrame, direction: str) -> bool:
-    last = df.iloc[-1]
-
-    if last["volume"] < last["vol_ma"] * VOLUME_MULTIPLIER:
+def breakout_confirmation(last: LastBar, direction: str) -> bool:
+    if last.volume < last.vol_ma * VOLUME_MULTIPLIER:
         return False
 
     if direction == "LONG":
-        return last["close"] > last["bb_high"]
+        return last.close > last.bb_high
     else:
-        return last["close"] < last["bb_low"]
+        return last.close < last.bb_low
 
 # =========================
 # SETUP RETROCESO FUERTE
 # =========================
 
-def pullback_confirmation(df: pd.DataFrame, direction: str) -> bool:
-    last = df.iloc[-1]
-
+def pullback_confirmation(last: LastBar, direction: str) -> bool:
     if direction == "LONG":
         return (
-            last["close"] >= last["bb_mid"]
-            and last["close"] > last["ema_200"]
-            and last["adx"] >= ADX_MIN_TREND
+            last.close >= last.bb_mid
+            and last.close > last.ema_200
+            and last.adx >= ADX_MIN_TREND
         )
     else:
         return (
-            last["close"] <= last["bb_mid"]
-            and last["close"] < last["ema_200"]
-            and last["adx"] >= ADX_MIN_TREND
+            last.close <= last.bb_mid
+            and last.close < last.ema_200
+            and last.adx >= ADX_MIN_TREND
         )
 
 # =========================
@@ -102,14 +221,14 @@ def pullback_confirmation(df: pd.DataFrame, direction: str) -> bool:
 # =========================
 
 def mtf_strategy(
-    df_1h: pd.DataFrame,
-    df_15m: pd.DataFrame,
-    df_5m: pd.DataFrame,
+    bars_1h: Bars,
+    bars_15m: Bars,
+    bars_5m: Bars,
 ) -> Optional[Dict]:
 
-    df_1h = add_indicators(df_1h)
-    df_15m = add_indicators(df_15m)
-    df_5m = add_indicators(df_5m)
+    # Cada temporalidad se calcula solo si la anterior pasó su filtro:
+    # la mayoría de símbolos se descarta ya en 1H.
+    last_1h = last_indicators(bars_1h, setup=False)
 
     score = 0
     components = []
@@ -118,10 +237,10 @@ def mtf_strategy(
     # 1H → FILTRO DURO
     # =====================
 
-    if not market_has_strength(df_1h):
+    if not market_has_strength(last_1h):
         return None
 
-    direction = trend_direction(df_1h)
+    direction = trend_direction(last_1h)
     if not direction:
         return None
 
@@ -132,7 +251,8 @@ def mtf_strategy(
     # 15M → CONTEXTO
     # =====================
 
-    if not market_has_strength(df_15m):
+    last_15m = last_indicators(bars_15m, setup=False)
+    if not market_has_strength(last_15m):
         return None
 
     score += 25
@@ -142,10 +262,10 @@ def mtf_strategy(
     # 5M → SETUP (BREAK O PULL)
     # =====================
 
-    last = df_5m.iloc[-1]
+    last = last_indicators(bars_5m)
 
-    is_breakout = breakout_confirmation(df_5m, direction)
-    is_pullback = pullback_confirmation(df_5m, direction)
+    is_breakout = breakout_confirmation(last, direction)
+    is_pullback = pullback_confirmation(last, direction)
 
     if not (is_breakout or is_pullback):
         return None
@@ -161,7 +281,7 @@ def mtf_strategy(
     # BONUS → FUERZA EXTRA
     # =====================
 
-    if last["adx"] >= 35:
+    if last.adx >= 35:
         score += 5
         components.append(("adx_bonus", 5))
 
@@ -169,7 +289,8 @@ def mtf_strategy(
 
     return {
         "direction": direction,
-        "entry_price": round(float(last["close"]), 4),
-        "score": round(score, 2),
+        "entry_price": round(last.close, 4),
+        "last_close": last.close,
+        "score": score,
         "components": components,
       }
@@ -0,0 +1,54 @@
+# tests/test_handlers.py
+
+import os
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+os.environ.setdefault("MONGODB_URI", "mongodb://localhost:27017")
+os.environ.setdefault("DATABASE_NAME", "hades_ft_test")
+
+from app import handlers
+from app.plans import PLAN_PREMIUM
+
+
+class _FutureCollection:
+    """Colección falsa que, como Motor, devuelve un Future en update_one."""
+
+    def __init__(self):
+        self.calls = []
+
+    def update_one(self, *args, **kwargs):
+        self.calls.append((args, kwargs))
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(None)
+        return future
+
+
+class HandleViewSignalsTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_background_touch_accepts_motor_future(self):
+        query = MagicMock()
+        query.message.reply_text = AsyncMock()
+        query.edit_message_text = AsyncMock()
+        users_col = _FutureCollection()
+        user = {"user_id": 1, "plan": PLAN_PREMIUM}
+
+        with patch.object(handlers, "get_latest_base_signal_for_plan", return_value=[{}, {}]), \
+                patch.object(handlers, "generate_user_signal", return_value={}), \
+                patch.object(handlers, "format_user_signal", side_effect=["a", "b"]):
+            await handlers.handle_view_signals(query, user, True, users_col)
+            await asyncio.sleep(0)
+
+        query.edit_message_text.assert_not_awaited()
+        self.assertEqual(len(users_col.calls), 1)
+
+        # En orden, y solo el último mensaje lleva el teclado de volver
+        sent = query.message.reply_text.await_args_list
+        self.assertEqual([c.args[0] for c in sent], ["a", "b"])
+        self.assertIsNone(sent[0].kwargs["reply_markup"])
+        self.assertIsNotNone(sent[1].kwargs["reply_markup"])
+
+
+if __name__ == "__main__":
+    unittest.main()